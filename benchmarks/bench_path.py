@@ -0,0 +1,78 @@
+"""
+AbbreviatedData 解析的微基准：旧的分词 + 逐个 pop 的方式对比单遍编译和缓存命中
+
+    python benchmarks/bench_path.py [路径段数]
+"""
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.path import compile_path  # noqa: E402
+
+COMMANDS = set("SMLQBAC")
+COMMAND_RE = re.compile(r"([SMLQBAC])")
+FLOAT_RE = re.compile(r"[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?")
+
+
+def tokenize_parse(pathdef):
+    """原先 _cairo_draw_path 的解析方式，只保留解析部分"""
+    elements = []
+    for x in COMMAND_RE.split(pathdef):
+        if x in COMMANDS:
+            elements.append(x)
+        elements.extend(FLOAT_RE.findall(x))
+    elements.reverse()
+    ops = []
+    arity = {"S": 2, "M": 2, "L": 2, "Q": 4, "B": 6, "A": 7, "C": 0}
+    while elements:
+        command = elements.pop()
+        ops.append((command, [float(elements.pop()) for _ in range(arity[command])]))
+    return ops
+
+
+def make_path(segments, seed=0):
+    rnd = random.Random(seed)
+
+    def pt():
+        return f"{rnd.uniform(0, 210):.3f} {rnd.uniform(0, 297):.3f}"
+
+    parts = [f"M {pt()}"]
+    for i in range(segments):
+        kind = i % 4
+        if kind == 0:
+            parts.append(f"L {pt()}")
+        elif kind == 1:
+            parts.append(f"B {pt()} {pt()} {pt()}")
+        elif kind == 2:
+            parts.append(f"Q {pt()} {pt()}")
+        else:
+            parts.append(f"A 5 3 30 0 1 {pt()}")
+    parts.append("C")
+    return " ".join(parts)
+
+
+def main():
+    segments = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    data = make_path(segments)
+    number = 200
+
+    def cold():
+        compile_path.cache_clear()
+        compile_path(data)
+
+    results = {
+        "tokenize + pop": timeit.timeit(lambda: tokenize_parse(data), number=number),
+        "compile_path (cold)": timeit.timeit(cold, number=number),
+        "compile_path (cached)": timeit.timeit(lambda: compile_path(data), number=number),
+    }
+    print(f"{segments} 段路径，{len(data)} 字节，每项 {number} 次")
+    for name, seconds in results.items():
+        print(f"{name:24s} {seconds / number * 1e6:10.1f} us/次")
+
+
+if __name__ == "__main__":
+    main()
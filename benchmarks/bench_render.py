@@ -0,0 +1,184 @@
+"""
+分阶段的渲染基准：打开文件、资源解码、每页绘制和编码分别计时，并记录峰值内存；
+资源解码按页面实际请求的分辨率在绘制过程中计时，不计入绘制，
+结果写成 JSON，便于在不同提交之间对比
+
+    python benchmarks/bench_render.py corpus/ -o results.json
+    python benchmarks/bench_render.py --generate 3 --pages 10 -o results.json
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from core.document import OFDFile, Surface, encode_image  # noqa: E402
+from core.resources import surface_cache  # noqa: E402
+from core.stats import RenderStats  # noqa: E402
+
+
+def peak_rss_kb(who=resource.RUSAGE_SELF):
+    # Linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+    rss = resource.getrusage(who).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ("-dirty" if dirty else "")
+
+
+def bench_file(path, output_format, dpi, quality, compress_level):
+    result = {"file": os.path.basename(path), "bytes": os.path.getsize(path)}
+    # 每个文件从冷缓存开始，解码时间才有可比性
+    surface_cache.clear()
+
+    start = time.perf_counter()
+    doc = OFDFile(path)
+    result["open"] = time.perf_counter() - start
+
+    document = doc.document
+    resources = document.resources
+    result["images"] = len(resources.images)
+    result["seals"] = len(resources.seals)
+
+    pages = []
+    for page in document.pages:
+        # 图片按页面上的像素大小缩小解码，解码耗时只能在绘制过程中取得：
+        # 由 RenderStats 的 decode 阶段记录，再从绘制耗时中扣除
+        stats = RenderStats()
+        doc.package.stats = stats
+        surface = Surface(page, result["file"], dpi=dpi)
+        start = time.perf_counter()
+        im = surface.rasterize()
+        elapsed = time.perf_counter() - start
+        doc.package.stats = None
+        decode = stats.stages.get("decode", [0, 0.0])[1]
+        draw = elapsed - decode
+
+        buffer = io.BytesIO()
+        start = time.perf_counter()
+        encode_image(im, buffer, output_format, quality, compress_level)
+        encode = time.perf_counter() - start
+        page.release()
+        pages.append({
+            "decode": decode,
+            "draw": draw,
+            "encode": encode,
+            "size": list(im.size),
+            "mode": im.mode,
+            "output_bytes": buffer.tell(),
+        })
+    doc.close()
+
+    result["pages"] = pages
+    result["decode"] = sum(p["decode"] for p in pages)
+    result["draw"] = sum(p["draw"] for p in pages)
+    result["encode"] = sum(p["encode"] for p in pages)
+    result["total"] = result["open"] + result["decode"] + result["draw"] + result["encode"]
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OFD 渲染分阶段基准")
+    parser.add_argument("inputs", nargs="*", help="OFD 文件或目录")
+    parser.add_argument("-o", "--output", help="结果 JSON 文件，默认输出到标准输出")
+    parser.add_argument("-f", "--format", default="png", choices=["png", "jpg", "webp"])
+    parser.add_argument("--dpi", type=float, default=192)
+    parser.add_argument("--quality", type=int)
+    parser.add_argument("--compress-level", type=int)
+    parser.add_argument("--repeat", type=int, default=1, help="每个文件重复次数")
+    parser.add_argument(
+        "--generate", type=int, default=0, help="不给出输入时生成的合成文件数，默认 3"
+    )
+    parser.add_argument("--pages", type=int, default=5, help="合成文件的页数")
+    args = parser.parse_args(argv)
+
+    paths = []
+    for item in args.inputs:
+        if os.path.isdir(item):
+            paths.extend(sorted(glob.glob(os.path.join(item, "**", "*.ofd"), recursive=True)))
+        else:
+            paths.append(item)
+
+    with tempfile.TemporaryDirectory() as folder:
+        if args.generate or not paths:
+            from make_corpus import make_ofd
+
+            for n in range(args.generate or 3):
+                paths.append(
+                    make_ofd(os.path.join(folder, f"corpus_{n}.ofd"), pages=args.pages, seed=n)
+                )
+
+        start = time.perf_counter()
+        runs = []
+        for _ in range(args.repeat):
+            for path in paths:
+                runs.append(
+                    bench_file(path, args.format, args.dpi, args.quality, args.compress_level)
+                )
+        elapsed = time.perf_counter() - start
+
+    page_count = sum(len(run["pages"]) for run in runs)
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {
+            "format": args.format,
+            "dpi": args.dpi,
+            "quality": args.quality,
+            "compress_level": args.compress_level,
+            "repeat": args.repeat,
+        },
+        "totals": {
+            "files": len(runs),
+            "pages": page_count,
+            "seconds": elapsed,
+            "pages_per_second": page_count / elapsed if elapsed else 0.0,
+            "open": sum(run["open"] for run in runs),
+            "decode": sum(run["decode"] for run in runs),
+            "draw": sum(run["draw"] for run in runs),
+            "encode": sum(run["encode"] for run in runs),
+        },
+        "peak_rss_kb": peak_rss_kb(),
+        "peak_rss_children_kb": peak_rss_kb(resource.RUSAGE_CHILDREN),
+        "runs": runs,
+    }
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        totals = report["totals"]
+        print(
+            f"{totals['files']} file(s), {totals['pages']} page(s) in {totals['seconds']:.2f}s "
+            f"({totals['pages_per_second']:.2f} pages/s): open {totals['open']:.2f}s, "
+            f"decode {totals['decode']:.2f}s, draw {totals['draw']:.2f}s, "
+            f"encode {totals['encode']:.2f}s, peak RSS {report['peak_rss_kb'] / 1024:.1f}MB"
+        )
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+生成用于基准测试的合成 OFD 文件，页数、文字、路径、图片、模板和签章的数量都可以控制
+
+    python benchmarks/make_corpus.py corpus --files 10 --pages 20 --texts 80 --paths 40
+"""
+import argparse
+import io
+import os
+import random
+import struct
+import zipfile
+
+import asn1
+from PIL import Image, ImageDraw, ImageOps
+
+NS = 'xmlns:ofd="http://www.ofdspec.org/2016"'
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>'
+IMAGE_FORMATS = ("jpg", "bmp", "jb2")
+FONTS = ("宋体", "楷体", "Courier New")
+CHARS = "发票代码号码开票日期校验码购买方名称纳税人识别号地址电话开户行及账号货物或应税劳务服务名称规格型号单位数量单价金额税率税额合计价税大写小写销售方收款人复核开票人备注0123456789"
+
+
+def _text_image(size, seed):
+    """
+    带文字和线框的灰度图，模拟扫描件
+    """
+    rnd = random.Random(seed)
+    im = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(im)
+    for _ in range(20):
+        x, y = rnd.randrange(size[0]), rnd.randrange(size[1])
+        draw.rectangle((x, y, x + rnd.randrange(5, 80), y + rnd.randrange(5, 40)), outline=0)
+        draw.text((x + 2, y + 2), f"{rnd.randrange(10 ** 8)}", fill=0)
+    return im
+
+
+def make_jpeg(size, seed):
+    rnd = random.Random(seed)
+    im = _text_image(size, seed).convert("RGB")
+    im.paste((rnd.randrange(256), 0, 0), (0, 0, size[0] // 4, size[1] // 4))
+    buffer = io.BytesIO()
+    im.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def make_bmp(size, seed):
+    buffer = io.BytesIO()
+    _text_image(size, seed).convert("RGB").save(buffer, "BMP")
+    return buffer.getvalue()
+
+
+def _g4_strip(im):
+    """
+    用 PIL（libtiff）把 1 位图编码为单条带的 CCITT G4 TIFF，取出条带数据。
+    MMR 数据中 0 为白、1 为黑；TIFF 的 PhotometricInterpretation 为 BlackIsZero 时
+    PIL 直接写出像素值（1 为白），此时需要反相后重新编码
+    """
+    for invert in (False, True):
+        buffer = io.BytesIO()
+        source = ImageOps.invert(im.convert("L")).convert("1") if invert else im
+        source.save(buffer, "TIFF", compression="group4", tiffinfo={278: im.height})
+        with Image.open(buffer) as tiff:
+            tags = tiff.tag_v2
+            offsets, counts = tags[273], tags[279]
+            photometric = tags.get(262, 0)
+        if len(offsets) != 1:
+            raise ValueError("Expected a single G4 strip")
+        if photometric == 0 or invert:
+            data = buffer.getvalue()
+            return data[offsets[0]:offsets[0] + counts[0]]
+
+
+def _jbig2_segment(number, segment_type, page, data):
+    # 段头：段号、段类型、无引用段、1 字节页号、数据长度
+    return struct.pack(">IBBBI", number, segment_type, 0, page, len(data)) + data
+
+
+def make_jb2(size, seed):
+    """
+    JBIG2 文件：页面信息段 + 一个 MMR 编码的立即通用区域段
+    """
+    im = _text_image(size, seed).convert("1")
+    width, height = size
+    page_info = struct.pack(">IIIIBH", width, height, 0, 0, 0, 0)
+    # 区域信息：宽、高、x、y、组合方式；通用区域标志：MMR = 1
+    region = struct.pack(">IIIIB", width, height, 0, 0, 0) + b"\x01" + _g4_strip(im)
+    return (
+        b"\x97JB2\r\n\x1a\n" + b"\x01" + struct.pack(">I", 1)
+        + _jbig2_segment(0, 48, 1, page_info)
+        + _jbig2_segment(1, 38, 1, region)
+        + _jbig2_segment(2, 49, 1, b"")
+        + _jbig2_segment(3, 51, 0, b"")
+    )
+
+
+def make_seal(size=(160, 160)):
+    """
+    SignedValue.dat：结构与 core.resources.Seal 的解析过程一致，印章图片为 GIF
+    """
+    im = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(im)
+    draw.ellipse((4, 4, size[0] - 4, size[1] - 4), outline=(220, 0, 0), width=6)
+    draw.text((size[0] // 3, size[1] // 2), "SEAL", fill=(220, 0, 0))
+    gif = io.BytesIO()
+    im.save(gif, "GIF")
+
+    encoder = asn1.Encoder()
+    encoder.start()
+    encoder.enter(asn1.Numbers.Sequence)  # SES_Signature
+    encoder.enter(asn1.Numbers.Sequence)  # TBS_Sign
+    encoder.write(4, asn1.Numbers.Integer)  # version
+    encoder.enter(asn1.Numbers.Sequence)  # SESeal
+    encoder.enter(asn1.Numbers.Sequence)  # SES_SealInfo
+    encoder.write(b"ES", asn1.Numbers.IA5String)
+    encoder.write(4, asn1.Numbers.Integer)
+    encoder.write(b"benchmark", asn1.Numbers.IA5String)
+    encoder.enter(asn1.Numbers.Sequence)  # SES_ESPictrueInfo
+    encoder.write(b"GIF", asn1.Numbers.IA5String)
+    encoder.write(gif.getvalue(), asn1.Numbers.OctetString)
+    for _ in range(5):
+        encoder.leave()
+    return encoder.output()
+
+
+def _text_object(rnd, object_id, font_ids):
+    text = "".join(rnd.choice(CHARS) for _ in range(rnd.randrange(2, 16)))
+    size = rnd.choice((3, 3.5, 4, 5))
+    x, y = rnd.uniform(5, 150), rnd.uniform(5, 280)
+    return (
+        f'<ofd:TextObject ID="{object_id}" Boundary="{x:.2f} {y:.2f} {size * len(text):.2f} {size * 1.5:.2f}" '
+        f'Font="{rnd.choice(font_ids)}" Size="{size}"><ofd:FillColor Value="0 0 0"/>'
+        f'<ofd:TextCode X="0" Y="{size:.2f}" DeltaX="g {len(text) - 1} {size}">{text}</ofd:TextCode>'
+        "</ofd:TextObject>"
+    )
+
+
+def _path_object(rnd, object_id):
+    def pt():
+        return f"{rnd.uniform(0, 60):.2f} {rnd.uniform(0, 30):.2f}"
+
+    parts = [f"M {pt()}"]
+    for _ in range(rnd.randrange(2, 12)):
+        parts.append(rnd.choice((
+            f"L {pt()}",
+            f"B {pt()} {pt()} {pt()}",
+            f"Q {pt()} {pt()}",
+            f"A 10 5 0 0 1 {pt()}",
+        )))
+    if rnd.random() < 0.5:
+        parts.append("C")
+    x, y = rnd.uniform(0, 150), rnd.uniform(0, 260)
+    color = " ".join(str(rnd.randrange(256)) for _ in range(3))
+    return (
+        f'<ofd:PathObject ID="{object_id}" Boundary="{x:.2f} {y:.2f} 60 30" LineWidth="0.3">'
+        f'<ofd:StrokeColor Value="{color}"/>'
+        f'<ofd:AbbreviatedData>{" ".join(parts)}</ofd:AbbreviatedData></ofd:PathObject>'
+    )
+
+
+def _image_object(rnd, object_id, resource_id):
+    x, y = rnd.uniform(0, 120), rnd.uniform(0, 220)
+    return (
+        f'<ofd:ImageObject ID="{object_id}" Boundary="{x:.2f} {y:.2f} 80 60" '
+        f'ResourceID="{resource_id}"/>'
+    )
+
+
+def make_ofd(
+    path,
+    pages=5,
+    texts=50,
+    paths=20,
+    images_per_page=1,
+    image_formats=IMAGE_FORMATS,
+    image_size=(800, 600),
+    templates=1,
+    seal=True,
+    seed=0,
+):
+    """
+    生成一个 OFD 文件，图片资源按格式各生成一个，各页轮流引用
+    """
+    rnd = random.Random(seed)
+    next_id = iter(range(1, 10 ** 9))
+    font_ids = [str(next(next_id)) for _ in FONTS]
+    image_ids = [str(next(next_id)) for _ in image_formats]
+    template_ids = [str(next(next_id)) for _ in range(templates)]
+    page_ids = [str(next(next_id)) for _ in range(pages)]
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("OFD.xml", (
+            f'{XML_HEADER}<ofd:OFD {NS} DocType="OFD" Version="1.0"><ofd:DocBody>'
+            "<ofd:DocInfo><ofd:DocID>benchmark</ofd:DocID></ofd:DocInfo>"
+            "<ofd:DocRoot>Doc_0/Document.xml</ofd:DocRoot></ofd:DocBody></ofd:OFD>"
+        ))
+        zf.writestr("Doc_0/Document.xml", (
+            f"{XML_HEADER}<ofd:Document {NS}><ofd:CommonData><ofd:MaxUnitID>{10 ** 8}</ofd:MaxUnitID>"
+            "<ofd:PageArea><ofd:PhysicalBox>0 0 210 297</ofd:PhysicalBox></ofd:PageArea>"
+            "<ofd:PublicRes>PublicRes.xml</ofd:PublicRes><ofd:DocumentRes>DocumentRes.xml</ofd:DocumentRes>"
+            + "".join(
+                f'<ofd:TemplatePage ID="{tpl_id}" BaseLoc="Tpls/Tpl_{i}/Content.xml"/>'
+                for i, tpl_id in enumerate(template_ids)
+            )
+            + "</ofd:CommonData><ofd:Pages>"
+            + "".join(
+                f'<ofd:Page ID="{page_id}" BaseLoc="Pages/Page_{i}/Content.xml"/>'
+                for i, page_id in enumerate(page_ids)
+            )
+            + "</ofd:Pages></ofd:Document>"
+        ))
+        zf.writestr("Doc_0/PublicRes.xml", (
+            f'{XML_HEADER}<ofd:Res {NS} BaseLoc="Res"><ofd:Fonts>'
+            + "".join(
+                f'<ofd:Font ID="{font_id}" FontName="{name}" FamilyName="{name}"/>'
+                for font_id, name in zip(font_ids, FONTS)
+            )
+            + "</ofd:Fonts></ofd:Res>"
+        ))
+        zf.writestr("Doc_0/DocumentRes.xml", (
+            f'{XML_HEADER}<ofd:Res {NS} BaseLoc="Res"><ofd:MultiMedias>'
+            + "".join(
+                f'<ofd:MultiMedia ID="{image_id}" Type="Image" Format="{fmt.upper()}">'
+                f"<ofd:MediaFile>image_{image_id}.{fmt}</ofd:MediaFile></ofd:MultiMedia>"
+                for image_id, fmt in zip(image_ids, image_formats)
+            )
+            + "</ofd:MultiMedias></ofd:Res>"
+        ))
+        makers = {"jpg": make_jpeg, "bmp": make_bmp, "jb2": make_jb2}
+        for image_id, fmt in zip(image_ids, image_formats):
+            zf.writestr(f"Doc_0/Res/image_{image_id}.{fmt}", makers[fmt](image_size, seed))
+
+        for i in range(templates):
+            objects = "".join(_path_object(rnd, next(next_id)) for _ in range(10))
+            objects += "".join(_text_object(rnd, next(next_id), font_ids) for _ in range(10))
+            zf.writestr(
+                f"Doc_0/Tpls/Tpl_{i}/Content.xml",
+                f'{XML_HEADER}<ofd:Page {NS}><ofd:Content><ofd:Layer ID="{next(next_id)}">'
+                f"{objects}</ofd:Layer></ofd:Content></ofd:Page>",
+            )
+
+        for i in range(pages):
+            objects = [_text_object(rnd, next(next_id), font_ids) for _ in range(texts)]
+            objects += [_path_object(rnd, next(next_id)) for _ in range(paths)]
+            if image_ids:
+                objects += [
+                    _image_object(rnd, next(next_id), image_ids[(i + k) % len(image_ids)])
+                    for k in range(images_per_page)
+                ]
+            template = (
+                f'<ofd:Template TemplateID="{template_ids[i % templates]}" ZOrder="Background"/>'
+                if templates else ""
+            )
+            zf.writestr(
+                f"Doc_0/Pages/Page_{i}/Content.xml",
+                f"{XML_HEADER}<ofd:Page {NS}>{template}<ofd:Content>"
+                f'<ofd:Layer ID="{next(next_id)}">{"".join(objects)}</ofd:Layer>'
+                "</ofd:Content></ofd:Page>",
+            )
+
+        if seal and pages:
+            zf.writestr("Doc_0/Signs/Signatures.xml", (
+                f"{XML_HEADER}<ofd:Signatures {NS}><ofd:MaxSignId>1</ofd:MaxSignId>"
+                '<ofd:Signature ID="1" Type="Seal" BaseLoc="/Doc_0/Signs/Sign_0/Signature.xml"/>'
+                "</ofd:Signatures>"
+            ))
+            zf.writestr("Doc_0/Signs/Sign_0/Signature.xml", (
+                f"{XML_HEADER}<ofd:Signature {NS}><ofd:SignedInfo>"
+                '<ofd:Provider ProviderName="benchmark"/>'
+                f'<ofd:StampAnnot ID="{next(next_id)}" PageRef="{page_ids[0]}" Boundary="140 240 40 40"/>'
+                "</ofd:SignedInfo>"
+                "<ofd:SignedValue>/Doc_0/Signs/Sign_0/SignedValue.dat</ofd:SignedValue>"
+                "</ofd:Signature>"
+            ))
+            zf.writestr("Doc_0/Signs/Sign_0/SignedValue.dat", make_seal())
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生成合成 OFD 测试文件")
+    parser.add_argument("destination", help="输出目录")
+    parser.add_argument("--files", type=int, default=5)
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--texts", type=int, default=50, help="每页 TextObject 数")
+    parser.add_argument("--paths", type=int, default=20, help="每页 PathObject 数")
+    parser.add_argument("--images-per-page", type=int, default=1)
+    parser.add_argument(
+        "--image-formats", default=",".join(IMAGE_FORMATS), help="逗号分隔，可选 jpg,bmp,jb2"
+    )
+    parser.add_argument("--image-size", default="800x600", help="图片像素大小，如 800x600")
+    parser.add_argument("--templates", type=int, default=1, help="模板页数，0 表示不使用模板")
+    parser.add_argument("--no-seal", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    image_formats = tuple(f for f in args.image_formats.split(",") if f)
+    for fmt in image_formats:
+        if fmt not in IMAGE_FORMATS:
+            parser.error(f"Unsupported image format '{fmt}'")
+    image_size = tuple(int(i) for i in args.image_size.lower().split("x"))
+
+    os.makedirs(args.destination, exist_ok=True)
+    for n in range(args.files):
+        path = os.path.join(args.destination, f"corpus_{n}.ofd")
+        make_ofd(
+            path,
+            pages=args.pages,
+            texts=args.texts,
+            paths=args.paths,
+            images_per_page=args.images_per_page,
+            image_formats=image_formats,
+            image_size=image_size,
+            templates=args.templates,
+            seal=not args.no_seal,
+            seed=args.seed + n,
+        )
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+按内容寻址的磁盘渲染缓存：同一份 OFD 以相同参数再次转换时直接复制上次的输出，不再打开 zip
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+# 绘制结果发生变化时递增，旧的缓存条目随之失效
+VERSION = "1"
+
+RENDER_CACHE_PATH = os.getenv("OFD_RENDER_CACHE")
+RENDER_CACHE_BYTES = int(os.getenv("OFD_RENDER_CACHE_BYTES", 1024 * 1024 * 1024))
+# 条目最近一次使用后保留的秒数，默认 30 天
+RENDER_CACHE_TTL = int(os.getenv("OFD_RENDER_CACHE_TTL", 30 * 24 * 3600))
+# 共用同一缓存目录的所有进程合计，至多每隔这么多秒清理一次
+RENDER_CACHE_EVICT_SECONDS = int(os.getenv("OFD_RENDER_CACHE_EVICT_SECONDS", 600))
+
+INDEX_NAME = "index.json"
+
+
+def file_digest(source):
+    """
+    OFD 内容的 sha256，source 为路径或内存中的数据
+    """
+    if not isinstance(source, (str, os.PathLike)):
+        return hashlib.sha256(source).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _normalize_pages(pages):
+    if pages is None or isinstance(pages, int):
+        return pages
+    if isinstance(pages, slice):
+        return ["slice", pages.start, pages.stop, pages.step]
+    return list(pages)
+
+
+class RenderCache(object):
+    """
+    root 下每个条目是一个目录，保存一次绘制的全部输出文件和 index.json；
+    条目先写入临时目录再整体改名，多个进程共用同一缓存目录时不会读到写了一半的条目
+    """
+
+    # 每写入这么多个条目检查一次是否需要清理，进程的第一次写入也检查
+    EVICT_INTERVAL = 64
+
+    def __init__(self, root=None, max_bytes=None, max_age=None):
+        root = root or RENDER_CACHE_PATH
+        if not root:
+            raise ValueError("Render cache directory is not set (OFD_RENDER_CACHE)")
+        self.root = Path(root)
+        self.max_bytes = RENDER_CACHE_BYTES if max_bytes is None else max_bytes
+        self.max_age = RENDER_CACHE_TTL if max_age is None else max_age
+        self._tmp = self.root / "tmp"
+        self._tmp.mkdir(parents=True, exist_ok=True)
+        self._puts = 0
+
+    @staticmethod
+    def key(digest, params):
+        """
+        OFD 内容摘要、绘制参数和 VERSION 共同决定缓存键
+        """
+        text = json.dumps(
+            {"digest": digest, "params": params, "version": VERSION}, sort_keys=True
+        )
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _entry(self, key):
+        return self.root / key[:2] / key
+
+    def get(self, key):
+        """
+        返回条目的 index（含 files 列表，文件名相对于条目目录）和条目目录，不存在时返回 None
+        """
+        entry = self._entry(key)
+        try:
+            with open(entry / INDEX_NAME, encoding="utf-8") as f:
+                index = json.load(f)
+            # 更新修改时间，过期按最近一次使用计算
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        return index, entry
+
+    def put(self, key, files, **info):
+        """
+        files: {条目中的文件名: 源文件路径}，复制进缓存；info 写入 index.json
+        """
+        tmp = Path(tempfile.mkdtemp(dir=self._tmp))
+        try:
+            nbytes = 0
+            for name, path in files.items():
+                shutil.copyfile(path, tmp / name)
+                nbytes += os.path.getsize(tmp / name)
+            index = dict(info, files=list(files), bytes=nbytes, created=time.time())
+            with open(tmp / INDEX_NAME, "w", encoding="utf-8") as f:
+                json.dump(index, f, ensure_ascii=False)
+            entry = self._entry(key)
+            entry.parent.mkdir(exist_ok=True)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # 其他进程已经写入了同一条目
+                pass
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self._puts += 1
+        if (self._puts == 1 or self._puts % self.EVICT_INTERVAL == 0) and self._claim_evict():
+            self.evict()
+
+    def _claim_evict(self):
+        """
+        清理要遍历整个缓存目录，用 tmp 下标记文件的修改时间在进程之间限制频率
+        """
+        marker = self._tmp / "evicted"
+        try:
+            if time.time() - marker.stat().st_mtime < RENDER_CACHE_EVICT_SECONDS:
+                return False
+        except OSError:
+            pass
+        marker.touch()
+        return True
+
+    def _remove(self, entry):
+        # 先改名再删除，正在读取的进程要么读到完整条目，要么读不到
+        trash = self._tmp / f"evict-{uuid.uuid4().hex}"
+        try:
+            os.rename(entry, trash)
+        except OSError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def evict(self):
+        """
+        删除超过 max_age 未使用的条目，总大小仍超过 max_bytes 时从最久未使用的开始删除
+        """
+        entries = []
+        now = time.time()
+        for bucket in self.root.iterdir():
+            if bucket == self._tmp or not bucket.is_dir():
+                continue
+            for entry in bucket.iterdir():
+                try:
+                    mtime = entry.stat().st_mtime
+                    with open(entry / INDEX_NAME, encoding="utf-8") as f:
+                        nbytes = json.load(f).get("bytes", 0)
+                except (OSError, ValueError):
+                    continue
+                if self.max_age and now - mtime > self.max_age:
+                    self._remove(entry)
+                else:
+                    entries.append((mtime, nbytes, entry))
+
+        total = sum(nbytes for _, nbytes, _ in entries)
+        for _, nbytes, entry in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            self._remove(entry)
+            total -= nbytes
+
+    def clear(self):
+        for bucket in self.root.iterdir():
+            if bucket != self._tmp and bucket.is_dir():
+                for entry in bucket.iterdir():
+                    self._remove(entry)
+
+
+_default_cache = None
+
+
+def default_cache():
+    """
+    由环境变量配置的缓存，进程内共用一个实例
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = RenderCache()
+    return _default_cache
+
+
+def render_cached(source, destination=None, cache: RenderCache = None, name=None, **options):
+    """
+    与 OFDFile(source).draw_document(destination, **options) 的结果相同，
+    命中缓存时只计算 source 的摘要并复制输出文件，不打开 zip
+
+    source: OFD 文件路径或内容（bytes、memoryview、mmap）
+    name: 输出文件名前缀，默认取自文件名，source 为内存数据时为 document
+    options: draw_document 的其他参数（workers、stats 不影响结果，不计入缓存键）
+    """
+    from .document import OFDFile
+
+    cache = cache or default_cache()
+    if name is None:
+        name = os.path.splitext(os.path.basename(source))[0] if isinstance(
+            source, (str, os.PathLike)
+        ) else "document"
+    params = {k: v for k, v in options.items() if k not in ("workers", "stats")}
+    params.setdefault("doc_num", 0)
+    params.setdefault("output_format", "png")
+    params["pages"] = _normalize_pages(params.get("pages"))
+    key = cache.key(file_digest(source), params)
+
+    destination = Path(destination or ".")
+    destination.mkdir(exist_ok=True, parents=True)
+    hit = cache.get(key)
+    if hit is not None:
+        index, entry = hit
+        paths = []
+        try:
+            for suffix in index["files"]:
+                path = destination / f"{name}{suffix}"
+                shutil.copyfile(entry / suffix, path)
+                paths.append(path)
+            return paths
+        except OSError:
+            # 条目刚好被淘汰，重新绘制
+            pass
+
+    with tempfile.TemporaryDirectory(dir=cache.root / "tmp") as folder:
+        with OFDFile(source, name=name) as doc:
+            rendered = doc.draw_document(destination=folder, **options)
+            pages = len(doc.page_timings)
+        # 缓存中的文件名去掉前缀，命中时按调用方的 name 命名
+        files = {os.path.basename(p)[len(name):]: p for p in rendered}
+        cache.put(key, files, pages=pages)
+        paths = []
+        for suffix, path in files.items():
+            target = destination / f"{name}{suffix}"
+            shutil.move(path, target)
+            paths.append(target)
+    return paths
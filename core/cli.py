@@ -0,0 +1,296 @@
+"""
+批量转换命令行
+
+    python ofd2img.py ofds/ -o out --workers 8 --manifest out/manifest.jsonl
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+
+def iter_inputs(inputs):
+    """
+    展开文件、目录（递归查找 .ofd）和通配符，返回 (源文件, 相对输出目录) 列表，
+    目录输入保留子目录结构，避免不同目录下同名文件互相覆盖
+    """
+    seen = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = [
+                (path, os.path.relpath(os.path.dirname(path), item))
+                for path in glob.glob(os.path.join(item, "**", "*.ofd"), recursive=True)
+            ]
+        elif os.path.isfile(item):
+            matches = [(item, ".")]
+        else:
+            matches = [(path, ".") for path in glob.glob(item, recursive=True)]
+        for path, rel_dir in sorted(matches):
+            key = os.path.abspath(path)
+            if key in seen or not os.path.isfile(path):
+                continue
+            seen.add(key)
+            yield key, rel_dir
+
+
+class Manifest(object):
+    """
+    JSONL 格式的转换记录，每个文件处理完立即追加一行，中断后重新运行可以接着转换；
+    同一文件以最后一条记录为准
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.fp = None
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 上次中断时可能留下不完整的最后一行
+                        continue
+                    self.records[record["source"]] = record
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.fp = open(path, "a", encoding="utf-8")
+
+    def get(self, source):
+        return self.records.get(source)
+
+    def add(self, record):
+        self.records[record["source"]] = record
+        if self.fp:
+            self.fp.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.fp.flush()
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+
+def is_up_to_date(record, source, destination, options):
+    """
+    源文件大小、修改时间、输出目录和转换参数与记录一致，且记录的输出文件都存在、不早于源文件
+    """
+    if not record or record.get("status") != "done":
+        return False
+    if record.get("destination") != destination or record.get("options") != options:
+        return False
+    stat = os.stat(source)
+    if record.get("size") != stat.st_size or record.get("mtime") != stat.st_mtime:
+        return False
+    for output in record.get("outputs", []):
+        if not os.path.exists(output) or os.path.getmtime(output) < stat.st_mtime:
+            return False
+    return True
+
+
+def _init_worker(strict_fonts):
+    """
+    工作进程启动时预先枚举系统字体，之后该进程处理的所有文件共用
+    """
+    if strict_fonts:
+        os.environ["OFD_FONT_MUST_EXIST"] = "1"
+    from .resources import font_families
+
+    try:
+        font_families()
+    except Exception:
+        # 字体枚举失败时留到真正绘制时再报错
+        pass
+
+
+def convert_file(source, destination, options):
+    """
+    转换单个文件，返回一条转换记录；失败时记录异常而不是抛出
+    """
+    from .document import OFDFile
+
+    record = _new_record(source, destination, options)
+    start = time.perf_counter()
+    try:
+        with OFDFile(source) as doc:
+            outputs = doc.draw_document(destination=destination, **options)
+            record.update(
+                status="done",
+                outputs=[os.path.abspath(p) for p in outputs],
+                pages=len(doc.page_timings),
+            )
+    except Exception as e:
+        record.update(status="failed", error=f"{type(e).__name__}: {e}")
+        traceback.print_exc()
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def _new_record(source, destination, options):
+    stat = os.stat(source)
+    return {
+        "source": source,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "destination": destination,
+        "options": options,
+    }
+
+
+def run_jobs(jobs, options, workers, strict_fonts, report):
+    """
+    多进程转换 jobs，每个文件完成后立即交给 report
+
+    工作进程意外退出（cairo / Pango 崩溃、被 OOM 终止）时整个进程池不可用，正在转换的文件
+    都会失败且无法判断是哪一个导致的：重建进程池，把这些文件逐个单独重试，
+    单独转换仍使进程退出的文件记为失败，其余文件照常继续
+    """
+    queue = deque(jobs)
+    suspects = deque()
+    while queue or suspects:
+        isolating = bool(suspects)
+        source_queue = suspects if isolating else queue
+        # 只保持有限个任务在队列中，文件数很多时不会一次性提交
+        limit = 1 if isolating else workers * 4
+        executor = ProcessPoolExecutor(
+            max_workers=1 if isolating else min(workers, len(queue)),
+            initializer=_init_worker,
+            initargs=(strict_fonts,),
+        )
+        running = {}
+        broken = False
+        try:
+            while running or (source_queue and not broken):
+                while source_queue and not broken and len(running) < limit:
+                    job = source_queue.popleft()
+                    try:
+                        running[executor.submit(convert_file, *job, options)] = job
+                    except BrokenProcessPool:
+                        source_queue.appendleft(job)
+                        broken = True
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    source, destination = running.pop(future)
+                    try:
+                        record = future.result()
+                    except BrokenProcessPool:
+                        broken = True
+                        if not isolating:
+                            suspects.append((source, destination))
+                            continue
+                        record = _new_record(source, destination, options)
+                        record.update(status="failed", error="Worker process exited unexpectedly")
+                    except Exception as e:
+                        record = _new_record(source, destination, options)
+                        record.update(status="failed", error=f"{type(e).__name__}: {e}")
+                    report(record)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="ofd2img", description="批量将 OFD 文件转换为图片或 PDF"
+    )
+    parser.add_argument("inputs", nargs="+", help="OFD 文件、目录或通配符")
+    parser.add_argument("-o", "--output", default=".", help="输出目录，默认为当前目录")
+    parser.add_argument(
+        "-f", "--format", default="png", choices=["png", "jpg", "jpeg", "webp", "pdf", "svg"]
+    )
+    parser.add_argument("--dpi", type=float, default=192)
+    parser.add_argument("--max-width", type=int)
+    parser.add_argument("--max-height", type=int)
+    parser.add_argument("--quality", type=int, help="jpg / webp 编码质量")
+    parser.add_argument("--compress-level", type=int, help="png 压缩级别")
+    parser.add_argument(
+        "-j", "--workers", type=int, default=os.cpu_count() or 1,
+        help="并行转换的进程数，默认为 CPU 核数",
+    )
+    parser.add_argument("--manifest", help="转换记录文件（JSONL），用于断点续转")
+    parser.add_argument("--force", action="store_true", help="忽略记录，全部重新转换")
+    parser.add_argument("--retry-failed", action="store_true", help="重新转换记录中失败的文件")
+    parser.add_argument(
+        "--strict-fonts", action="store_true", help="缺少字体时报错（OFD_FONT_MUST_EXIST）"
+    )
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    options = {
+        "output_format": args.format,
+        "dpi": args.dpi,
+        "max_width": args.max_width,
+        "max_height": args.max_height,
+        "quality": args.quality,
+        "compress_level": args.compress_level,
+    }
+    if args.strict_fonts:
+        os.environ["OFD_FONT_MUST_EXIST"] = "1"
+
+    manifest = Manifest(args.manifest)
+    jobs = []
+    skipped = 0
+    for source, rel_dir in iter_inputs(args.inputs):
+        destination = os.path.abspath(os.path.join(args.output, rel_dir))
+        if args.format not in ("pdf", "svg"):
+            # 每个文件的图片放在以文件名命名的子目录中
+            destination = os.path.join(destination, Path(source).stem)
+        record = manifest.get(source)
+        if not args.force and record:
+            if is_up_to_date(record, source, destination, options) or (
+                record.get("status") == "failed" and not args.retry_failed
+            ):
+                skipped += 1
+                continue
+        jobs.append((source, destination))
+
+    total = len(jobs)
+    print(f"{total} file(s) to convert, {skipped} skipped")
+    pages = done = failed = 0
+    start = time.perf_counter()
+
+    def report(record):
+        nonlocal pages, done, failed
+        manifest.add(record)
+        if record["status"] == "done":
+            done += 1
+            pages += record["pages"]
+            status = f"{record['pages']} page(s) in {record['seconds']:.2f}s"
+        else:
+            failed += 1
+            status = f"FAILED: {record['error']}"
+        print(f"[{done + failed}/{total}] {record['source']}: {status}")
+
+    try:
+        if args.workers <= 1 or total <= 1:
+            _init_worker(args.strict_fonts)
+            for source, destination in jobs:
+                report(convert_file(source, destination, options))
+        else:
+            run_jobs(jobs, options, args.workers, args.strict_fonts, report)
+    except KeyboardInterrupt:
+        print("Interrupted, rerun with the same --manifest to resume")
+    finally:
+        manifest.close()
+
+    elapsed = time.perf_counter() - start
+    rate = pages / elapsed if elapsed > 0 else 0.0
+    print(
+        f"Converted {done} file(s), {pages} page(s) in {elapsed:.1f}s "
+        f"({rate:.2f} pages/s), {failed} failed, {skipped} skipped"
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,23 @@
 import os
+import posixpath
+import threading
+import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Optional
 from zipfile import ZipFile
 
-import cssselect2
 from defusedxml import ElementTree
 
 from .constants import UNITS
-from .resources import res_add_font, res_add_multimedia, res_add_signature
+from .package import BufferReader, PackageIndex, open_zip
+from .pngwriter import PNGWriter
+from .sinks import FileSink, MemorySink
+from .resources import ResourceRegistry, res_add_font, res_add_multimedia, res_add_signature
+from .stats import RenderStats
 from .surface import cairo, cairo_path, cairo_text, cairo_image, cairo_seal
 from pathlib import Path
 from PIL import Image, ImageStat
-from io import BytesIO
-import tempfile
-import shutil
 
 
 class OFDFile(object):
@@ -23,49 +27,394 @@ class OFDFile(object):
 
     #: contains OFD file header data
     header = None
-    #: references to document's resources
-    resources = None
     zf: ZipFile
 
-    def __init__(self, file_path):
-        self.zf = ZipFile(file_path)
+    def __init__(self, file_path, stats: Optional[RenderStats] = None, name: Optional[str] = None):
+        """
+        file_path: 文件路径，也可以是 bytes、memoryview、mmap 或以二进制方式打开的文件对象，
+            内存中的数据直接读取，不需要先写入临时文件
+        stats: 可选的 RenderStats，记录打开文件和之后每次绘制的统计
+        name: 输出文件名前缀，默认取自文件名，没有文件名时为 document
+        """
+        start = time.perf_counter()
+        self.source = file_path
+        self.page_timings = {}
+        self.stats = stats
+        self.render_stats = None
+        if name is None:
+            # 打开的文件对象带有 name 属性，内存中的数据没有
+            path = getattr(file_path, "name", file_path)
+            if isinstance(path, (str, os.PathLike)):
+                name = os.path.splitext(os.path.basename(path))[0]
+            else:
+                name = "document"
+        self.name = name
+        self.zf = open_zip(file_path)
         # for info in self._zf.infolist():
         #     print(info)
+        self.package = PackageIndex(self.zf)
+        self.package.stats = stats
         self.node_tree = self.read_node("OFD.xml")
 
-        # parse node
-        self.document_node = self.read_node(self.node_tree["DocBody"]["DocRoot"].text)
-        self.document = OFDDocument(self.zf, self.document_node)
-        # print_node_recursive(self.document_node)
+        # 一个包中可以有多个文档，打开时只记录各文档的入口，用到时才解析
+        doc_bodies = self.node_tree["DocBody"]
+        if not isinstance(doc_bodies, list):
+            doc_bodies = [doc_bodies]
+        self.doc_bodies = doc_bodies
+        self._documents = {}
+        self._documents_lock = threading.Lock()
+        if stats is not None:
+            stats.add_stage("open", time.perf_counter() - start)
 
     def read_node(self, location):
-        document = self.zf.read(location)
-        tree = ElementTree.fromstring(document)
-        root = cssselect2.ElementWrapper.from_xml_root(tree)
-        return Node(root)
-
-    def draw_document(self, doc_num=0, destination: Optional[str] = None, output_format: Optional[str] = "png"):
-        document = self.document
-        destination = destination or "."
-        destination = Path(destination)
-        destination.mkdir(exist_ok=True, parents=True)
-        paths = []
-        for i, page in enumerate(document.pages):
-            surface = Surface(page, os.path.split(self.zf.filename)[-1].strip(".ofd"))
-            paths.append(
-                surface.draw(page, destination / Path(f"{surface.filename}_{i}.{output_format}"))
-            )
-        shutil.rmtree(self.document.work_folder, ignore_errors=True)
-        return paths
+        return _read_xml(self.package, self.package.resolve(location))
+
+    @property
+    def document_count(self):
+        return len(self.doc_bodies)
+
+    def get_document(self, n=0) -> "OFDDocument":
+        """
+        第 n 个文档（从 0 开始），第一次访问时解析，各文档的资源和临时目录互相独立
+        """
+        if not 0 <= n < len(self.doc_bodies):
+            raise IndexError(f"Document {n} out of range, the file has {len(self.doc_bodies)}")
+        with self._documents_lock:
+            if n not in self._documents:
+                body = self.doc_bodies[n]
+                root = self.package.resolve(body["DocRoot"].text)
+                if root is None:
+                    raise KeyError(f"There is no item named '{body['DocRoot'].text}'")
+                signatures = body["Signatures"].text if "Signatures" in body else None
+                self._documents[n] = OFDDocument(
+                    self.package, _read_xml(self.package, root), n,
+                    base=posixpath.dirname(root), signatures=signatures,
+                )
+            return self._documents[n]
+
+    @property
+    def document(self):
+        return self.get_document(0)
+
+    @property
+    def resources(self):
+        return self.document.resources
+
+    def output_prefix(self, doc_num=0):
+        """
+        输出文件名前缀，第一个文档沿用 name，其余文档加上 _Doc_n 避免重名
+        """
+        return self.name if doc_num == 0 else f"{self.name}_Doc_{doc_num}"
+
+    def _worker_source(self):
+        """
+        交给工作进程的输入：路径原样传递，内存中的数据和文件对象转换为 bytes
+        """
+        source = self.source
+        if isinstance(source, (str, os.PathLike, bytes)):
+            return source
+        if isinstance(self.zf.fp, BufferReader):
+            return self.zf.fp.getbuffer().tobytes()
+        position = source.tell()
+        source.seek(0)
+        try:
+            return source.read()
+        finally:
+            source.seek(position)
+
+    def close(self):
+        for document in self._documents.values():
+            document.close()
+        self._documents = {}
+        self.zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def draw_document(
+        self,
+        doc_num=0,
+        destination: Optional[str] = None,
+        output_format: Optional[str] = "png",
+        pages=None,
+        workers: int = 0,
+        quality: Optional[int] = None,
+        compress_level: Optional[int] = None,
+        band_height: Optional[int] = None,
+        dpi: float = 192,
+        max_width: Optional[int] = None,
+        max_height: Optional[int] = None,
+        stats=None,
+        sink=None,
+    ):
+        """
+        doc_num: 文档序号（从 0 开始），也可以是序号列表，多个文档同时绘制；
+            第一个文档的输出文件名前缀为 name，其余文档为 name_Doc_n
+        pages: 需要绘制的页码（从 0 开始），None 表示全部页面；未选中的页面不会从 zip 中读取
+        workers: 大于 1 时使用多进程并行绘制，每个进程自己打开 OFD 文件，输出顺序和文件名与单进程一致
+        output_format: png、jpg 或 webp；quality 用于 jpg / webp，compress_level 用于 png。
+            pdf 会把所有页面以矢量方式写入同一个文件，svg 每页输出一个矢量文件
+        dpi: 位图输出的分辨率；给出 max_width / max_height 时按比例缩小到不超过该像素大小，
+            页面中的图片也按接近目标的分辨率解码，适合生成缩略图
+        band_height: 高分辨率大幅面页面按该像素高度分条绘制，只支持 png
+
+        stats: RenderStats 或回调函数，收集各阶段耗时、读取字节数和缓存命中情况，
+            默认使用打开文件时传入的 stats；结果同时保存在 self.render_stats 中
+        sink: 输出位置，见 core.sinks，默认为 FileSink(destination)；返回值为各输出的 sink.result()
+
+        每页的绘制耗时（秒）记录在 self.page_timings 中，可以据此确定进程数；
+            doc_num 为列表时键为 (文档序号, 页码)
+        """
+        if sink is None:
+            sink = FileSink(destination or ".")
+        doc_nums = [doc_num] if isinstance(doc_num, int) else list(doc_num)
+        options = (output_format, quality, compress_level, band_height)
+        render_options = (dpi, max_width, max_height)
+
+        callback = None
+        if stats is None:
+            stats = self.stats
+        elif not isinstance(stats, RenderStats):
+            # 传入回调函数时，绘制结束后把本次的统计结果交给它
+            callback, stats = stats, RenderStats()
+
+        def draw(n, indexes):
+            try:
+                return self._draw_pages(
+                    n, sink, output_format, indexes, workers, options, render_options, stats
+                )
+            finally:
+                self.get_document(n).resources.work_folder.cleanup()
+
+        # 解析文档时读取和解析 XML、资源的耗时也计入本次统计
+        self.package.stats = stats
+        try:
+            # 先解析全部文档并确定各自的页码，文档序号或页码不合法时在写出任何结果之前报错
+            selected = [
+                [i for i, _ in self.get_document(n).select_pages(pages)] for n in doc_nums
+            ]
+            if len(doc_nums) > 1 and workers <= 1:
+                # 多个文档各用一个线程绘制；workers 大于 1 时每个文档已经使用多进程，按顺序绘制
+                with ThreadPoolExecutor(max_workers=len(doc_nums)) as executor:
+                    drawn = list(executor.map(draw, doc_nums, selected))
+            else:
+                drawn = [draw(n, indexes) for n, indexes in zip(doc_nums, selected)]
+        finally:
+            self.package.stats = self.stats
+
+        if isinstance(doc_num, int):
+            self.page_timings = {i: elapsed for i, (_, elapsed) in drawn[0]}
+        else:
+            self.page_timings = {
+                (n, i): elapsed for n, results in zip(doc_nums, drawn) for i, (_, elapsed) in results
+            }
+        self.render_stats = stats
+        if callback is not None:
+            callback(stats)
+        return list(dict.fromkeys(path for results in drawn for _, (path, _) in results))
+
+    def _draw_pages(self, doc_num, sink, output_format, indexes, workers, options, render_options, stats):
+        """
+        绘制一个文档中 indexes 给出的页面，返回 [(页码, (sink.result, 耗时))]
+        """
+        document = self.get_document(doc_num)
+        filename = self.output_prefix(doc_num)
+        names = [f"{filename}_{i}.{output_format}" for i in indexes]
+        if output_format in VECTOR_FORMATS:
+            if output_format == "pdf":
+                names = [f"{filename}.pdf"]
+            results = self._draw_vector(document, indexes, names, filename, output_format, sink)
+        elif workers > 1 and len(indexes) > 1:
+            # 输出到目录时工作进程直接写文件，其他情况把编码后的数据传回主进程写入 sink
+            worker_destination = sink.destination if isinstance(sink, FileSink) else None
+            results = []
+            with ProcessPoolExecutor(
+                max_workers=min(workers, len(indexes)),
+                initializer=_init_page_worker,
+                initargs=(self._worker_source(),),
+            ) as executor:
+                for name, elapsed, worker_stats, data in executor.map(
+                    _draw_page_worker,
+                    [doc_num] * len(indexes),
+                    indexes,
+                    names,
+                    [filename] * len(indexes),
+                    [options] * len(indexes),
+                    [render_options] * len(indexes),
+                    [stats is not None] * len(indexes),
+                    [worker_destination] * len(indexes),
+                ):
+                    if worker_stats is not None:
+                        stats.merge(worker_stats)
+                    if data is not None:
+                        sink.write(name, data)
+                    results.append((sink.result(name), elapsed))
+        else:
+            results = [
+                _draw_page(document, i, name, filename, options, render_options, sink)
+                for i, name in zip(_prefetching(document, indexes), names)
+            ]
+        return list(zip(indexes, results))
+
+    def iter_pages(
+        self,
+        doc_num=0,
+        output_format: Optional[str] = "png",
+        pages=None,
+        quality: Optional[int] = None,
+        compress_level: Optional[int] = None,
+        band_height: Optional[int] = None,
+        dpi: float = 192,
+        max_width: Optional[int] = None,
+        max_height: Optional[int] = None,
+    ):
+        """
+        逐页绘制，每页编码完成后立即产出 (页码, 文件名, 编码后的字节)，
+        调用方可以一边发送前面的页面一边绘制后面的页面，内存中只保留当前页。
+        参数与 draw_document 相同；pdf 需要写入同一个文件，请使用 draw_document(sink=...)
+        """
+        if output_format == "pdf":
+            raise ValueError("iter_pages does not support pdf, use draw_document(sink=...)")
+        document = self.get_document(doc_num)
+        filename = self.output_prefix(doc_num)
+        options = (output_format, quality, compress_level, band_height)
+        render_options = (dpi, max_width, max_height)
+        sink = MemorySink()
+        try:
+            indexes = [i for i, _ in document.select_pages(pages)]
+            for i in _prefetching(document, indexes):
+                name = f"{filename}_{i}.{output_format}"
+                if output_format in VECTOR_FORMATS:
+                    self._draw_vector(document, [i], [name], filename, output_format, sink)
+                else:
+                    _draw_page(document, i, name, filename, options, render_options, sink)
+                yield i, name, sink.pop(name)
+        finally:
+            document.resources.work_folder.cleanup()
+
+    @staticmethod
+    def _draw_vector(document, indexes, names, filename, output_format, sink):
+        """
+        在 cairo 的 PDF / SVG surface 上重放与位图相同的绘制过程，坐标单位为 pt
+        """
+        results = []
+        pdf = pdf_file = None
+        for n, i in enumerate(_prefetching(document, indexes)):
+            start = time.perf_counter()
+            page = document.pages[i]
+            document.resources.prefetch(**page.dependencies())
+            surface = Surface(page, filename, dpi=72)
+            width = page.physical_box[2] * surface.pixels_per_mm
+            height = page.physical_box[3] * surface.pixels_per_mm
+            if output_format == "pdf":
+                name = names[0]
+                if pdf is None:
+                    pdf_file = sink.open(name)
+                    pdf = cairo.PDFSurface(pdf_file, width, height)
+                else:
+                    pdf.set_size(width, height)
+                target = pdf
+            else:
+                name = names[n]
+                f = sink.open(name)
+                target = cairo.SVGSurface(f, width, height)
+
+            cr = cairo.Context(target)
+            cr.scale(surface.pixels_per_mm, surface.pixels_per_mm)
+            surface.render(cr)
+            cr.show_page()
+            if target is not pdf:
+                target.finish()
+                f.close()
+            page.release()
+            results.append((sink.result(name), time.perf_counter() - start))
+        if pdf is not None:
+            pdf.finish()
+            pdf_file.close()
+        return results
+
+
+# 绘制一页的同时在后台读取下一页的内容和它用到的资源，设置 OFD_PREFETCH=1 开启
+PREFETCH = os.getenv("OFD_PREFETCH", "0") == "1"
+
+
+def _prefetching(document, indexes):
+    """
+    依次产出 indexes 中的页码，开启 PREFETCH 时产出每一页之前先在后台准备下一页
+    """
+    if not PREFETCH or len(indexes) < 2:
+        yield from indexes
+        return
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="ofd-prefetch") as executor:
+        for n, i in enumerate(indexes):
+            if n + 1 < len(indexes):
+                executor.submit(document.prefetch, indexes[n + 1])
+            yield i
+
+
+def _draw_page(document, i, name, filename, options, render_options, sink=None):
+    start = time.perf_counter()
+    page = document.pages[i]
+    # 绘制前一次性准备本页的全部资源，页面中的 jb2 同时交给 jbig2dec 并行解码
+    document.resources.prefetch(**page.dependencies())
+    surface = Surface(page, filename, *render_options)
+    result = surface.draw(page, name, *options, sink=sink)
+    page.release()
+    return result, time.perf_counter() - start
+
+
+# 多进程绘制时每个工作进程各自打开的 OFD 文件
+_worker_file = None
+
+
+def _init_page_worker(source):
+    global _worker_file
+    _worker_file = OFDFile(source)
+
+
+def _draw_page_worker(
+    doc_num, i, name, filename, options, render_options, collect_stats=False, destination=None
+):
+    """
+    destination 为 None 时把编码后的数据返回主进程；
+    collect_stats 为 True 时返回本页的统计数据，由主进程合并
+    """
+    stats = RenderStats() if collect_stats else None
+    sink = FileSink(destination) if destination is not None else MemorySink()
+    _worker_file.package.stats = stats
+    try:
+        _, elapsed = _draw_page(
+            _worker_file.get_document(doc_num), i, name, filename, options, render_options, sink
+        )
+    finally:
+        _worker_file.package.stats = None
+    data = sink.pop(name) if isinstance(sink, MemorySink) else None
+    return name, elapsed, stats.as_dict() if stats is not None else None, data
+
+
+def _read_xml(package: PackageIndex, path):
+    data = package.read(path)
+    if package.stats is None:
+        return Node.from_bytes(data)
+    with package.stats.stage("xml_parse"):
+        return Node.from_bytes(data)
 
 
 class OFDDocument(object):
-    def __init__(self, _zf, node, n=0):
+    def __init__(self, package: PackageIndex, node, n=0, base=None, signatures=None):
+        """
+        base: 文档目录（DocRoot 所在目录），文档内的相对路径基于此查找，默认为 Doc_n
+        signatures: OFD.xml 中 DocBody 给出的签名列表文件，默认为 base/Signs/Signatures.xml
+        """
         self.pages = []
         self.signatures = []
-        self._zf = _zf
-        self.work_folder = tempfile.mkdtemp()
+        self._package = package
+        self.resources = ResourceRegistry(package)
         self.name = f"Doc_{n}"
+        self.base = self.name if base is None else base
         self.node = node
         self.physical_box = [
             float(i)
@@ -85,163 +434,499 @@ class OFDDocument(object):
                 )
             else:
                 sorted_tpls = [node["CommonData"]["TemplatePage"]]
-        if f"{self.name}/Signs/Signatures.xml" in self._zf.namelist():
-            node = Node.from_zp_location(
-                self._zf, f"{self.name}/Signs/Signatures.xml"
-            )
+        self.templates = {tpl.attr["ID"]: tpl.attr["BaseLoc"] for tpl in sorted_tpls}
+        # 模板页通常被所有页面共用，解析结果和绘制结果都按文档缓存
+        self._template_nodes = {}
+        self._template_dependencies = {}
+        self._template_lock = threading.Lock()
+        self.template_surfaces = {}
+        self.template_bytes = 0
+        signs_path = self._package.resolve(signatures) if signatures else None
+        if signs_path is None and f"{self.base}/Signs/Signatures.xml" in self._package:
+            signs_path = self._package.resolve(f"{self.base}/Signs/Signatures.xml")
+        signs_dir = posixpath.dirname(signs_path) if signs_path else f"{self.base}/Signs"
+        self._signs_dir = signs_dir
+        if signs_path is not None:
+            node = _read_xml(self._package, signs_path)
             if isinstance(node["Signature"], list):
                 for sign in node["Signature"]:
                     self.signatures.append(sign)
             else:
                 self.signatures.append(node["Signature"])
+        for sign in self.signatures:
+            # BaseLoc 统一换成包内的完整路径
+            sign.attr["BaseLoc"] = (
+                self._package.resolve(sign.attr["BaseLoc"], signs_dir)
+                or sign.attr["BaseLoc"]
+            )
 
         self._parse_res()
-        # print('Resources:', Fonts, Images)
+        # print('Resources:', self.resources.fonts, self.resources.images)
         # assert len(node['CommonData']['TemplatePage']) == len(node['Pages']['Page'])
 
         seal_nodes = {}
         for sign in (s for s in self.signatures if s.attr["Type"] == "Seal"):
-            sign.attr['BaseLoc'] = sign.attr['BaseLoc'].replace(f"/{self.name}/Signs/", "")
-            node = Node.from_zp_location(
-                self._zf, f"{self.name}/Signs/{sign.attr['BaseLoc']}"
-            )
+            node = _read_xml(self._package, sign.attr["BaseLoc"])
             seal_node = node["SignedInfo"]["StampAnnot"]
             seal_node.attr.update({
                 "ID": sign.attr["ID"],
-                "BaseLoc": f"{self.name}/Signs/{sign.attr['BaseLoc']}",
+                "BaseLoc": sign.attr["BaseLoc"],
             })
             seal_nodes[seal_node.attr["PageRef"]] = seal_node
 
+        # 只保留页面索引，页面内容在绘制时才读取
         for i, p in enumerate(sorted_pages):
-            page_node = Node.from_zp_location(
-                _zf, self.name + "/" + sorted_pages[i].attr["BaseLoc"]
-            )
-
-            tpl_node = None
-            if i < len(sorted_tpls):
-                tpl_node = Node.from_zp_location(
-                    _zf, self.name + "/" + sorted_tpls[i].attr["BaseLoc"]
-                )
-
+            tpl_id = sorted_tpls[i].attr["ID"] if i < len(sorted_tpls) else None
             self.pages.append(
                 OFDPage(
                     self,
                     f"Page_{i}",
-                    page_node,
-                    tpl_node,
+                    p.attr["ID"],
+                    p.attr["BaseLoc"],
+                    tpl_id,
                     seal_nodes.get(p.attr["ID"]),
                 )
             )
 
+    def read_node(self, location):
+        path = self._package.resolve(location, self.base)
+        if path is None:
+            raise KeyError(f"There is no item named '{location}' in {self.base}")
+        return _read_xml(self._package, path)
+
+    def get_template_node(self, tpl_id):
+        """
+        每个模板只读取、解析一次
+        """
+        with self._template_lock:
+            if tpl_id not in self._template_nodes:
+                tpl_loc = self.templates.get(tpl_id)
+                node = self.read_node(tpl_loc) if tpl_loc else None
+                self._template_nodes[tpl_id] = node
+                self._template_dependencies[tpl_id] = _collect_dependencies(node)
+            return self._template_nodes[tpl_id]
+
+    def get_template_dependencies(self, tpl_id):
+        self.get_template_node(tpl_id)
+        return self._template_dependencies[tpl_id]
+
+    def prefetch(self, i):
+        """
+        读取第 i 页并准备它用到的图片、印章和字体，供后台线程调用
+        """
+        self.resources.prefetch(**self.pages[i].dependencies())
+
+    def close(self):
+        self.resources.close()
+        self.pages = []
+        self._template_nodes = {}
+        self._template_dependencies = {}
+        self.template_surfaces = {}
+        self.template_bytes = 0
+
+    def select_pages(self, pages=None):
+        """
+        pages 可以是页码（从 0 开始）、页码序列、range 或 slice，None 表示全部页面
+        """
+        if pages is None:
+            return list(enumerate(self.pages))
+        if isinstance(pages, int):
+            pages = [pages]
+        elif isinstance(pages, slice):
+            pages = range(len(self.pages))[pages]
+        selected = []
+        for i in pages:
+            # 负数页码不按 Python 下标解释，否则输出文件名和 page_timings 中的页码对不上
+            if not 0 <= i < len(self.pages):
+                raise IndexError(f"Page {i} out of range, the document has {len(self.pages)}")
+            selected.append((i, self.pages[i]))
+        return selected
+
     def _parse_res(self):
-        if "DocumentRes" in self.node["CommonData"]:
-            node = Node.from_zp_location(
-                self._zf, f"{self.name}/{self.node['CommonData']['DocumentRes'].text}"
-            )
-            self._parse_res_node(node)
+        for res in ("DocumentRes", "PublicRes"):
+            if res in self.node["CommonData"]:
+                self._parse_res_file(self.node["CommonData"][res].text)
 
-        if "PublicRes" in self.node["CommonData"]:
-            node = Node.from_zp_location(
-                self._zf, f"{self.name}/{self.node['CommonData']['PublicRes'].text}"
-            )
-            self._parse_res_node(node)
+        for node in self.signatures:
+            self._parse_res_node(node, (self._signs_dir,))
 
-        if f"{self.name}/Signs/Signatures.xml" in self._zf.namelist():
-            for node in self.signatures:
-                self._parse_res_node(node)
+    def _parse_res_file(self, location):
+        path = self._package.resolve(location, self.base)
+        if path is None:
+            print(f"Resource file '{location}' not found in {self.base}")
+            return
+        node = _read_xml(self._package, path)
+        # 资源文件中的路径相对于其 BaseLoc，BaseLoc 又相对于资源文件所在目录
+        res_dir = posixpath.dirname(path)
+        bases = (res_dir, self.base)
+        if "BaseLoc" in node.attr:
+            bases = (PackageIndex.join(res_dir, node.attr["BaseLoc"]),) + bases
+        self._parse_res_node(node, bases)
 
-    def _parse_res_node(self, node):
+    def _parse_res_node(self, node, bases):
         if node.tag in RESOURCE_TAGS:
+            start = time.perf_counter()
             try:
-                RESOURCE_TAGS[node.tag](node, self._zf, self.work_folder)
+                RESOURCE_TAGS[node.tag](node, self.resources, bases)
             except Exception as e:
                 # Error in point parsing, do nothing
                 print_node_recursive(node)
                 print(traceback.format_exc())
                 pass
+            if self._package.stats is not None:
+                self._package.stats.add_tag("res", node.tag, time.perf_counter() - start)
             return  # no need to go deeper
 
         for child in node.children:
-            self._parse_res_node(child)
+            self._parse_res_node(child, bases)
+
+
+def _collect_dependencies(node):
+    """
+    遍历页面或模板内容，收集 ImageObject 的 ResourceID 和 TextObject 的 Font
+    """
+    dependencies = {"images": set(), "fonts": set(), "seals": set()}
+    stack = [node] if node is not None else []
+    while stack:
+        node = stack.pop()
+        if node.tag == "ImageObject" and "ResourceID" in node.attr:
+            dependencies["images"].add(node.attr["ResourceID"])
+        elif node.tag == "TextObject" and "Font" in node.attr:
+            dependencies["fonts"].add(node.attr["Font"])
+        stack.extend(node.children)
+    return dependencies
 
 
 class OFDPage(object):
-    def __init__(self, parent: OFDDocument, name, page_node, tpl_node, seal_node):
+    def __init__(self, parent: OFDDocument, name, page_id, base_loc, tpl_id, seal_node):
         self.parent = parent
         self.name = f"{parent.name}_{name}"
-        self.physical_box = self.parent.physical_box
+        self.id = page_id
+        self.base_loc = base_loc
+        self.tpl_id = tpl_id
+        self.seal_node = seal_node
+        self._page_node = None
+        self._tpl_node = None
+        self._dependencies = None
+        # 后台预读和绘制可能同时加载同一页
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._page_node is not None:
+                return
+            page_node = self.parent.read_node(self.base_loc)
+            # 页面自身声明的模板优先于按顺序对应的模板
+            if "Template" in page_node:
+                template = page_node["Template"]
+                if isinstance(template, list):
+                    template = template[0]
+                self.tpl_id = template.attr.get("TemplateID", self.tpl_id)
+            self._tpl_node = self.parent.get_template_node(self.tpl_id)
+            if self._dependencies is None:
+                dependencies = _collect_dependencies(page_node)
+                for kind, ids in self.parent.get_template_dependencies(self.tpl_id).items():
+                    dependencies[kind] |= ids
+                if self.seal_node is not None:
+                    dependencies["seals"].add(self.seal_node.attr["ID"])
+                self._dependencies = dependencies
+            self._page_node = page_node
+
+    def dependencies(self):
+        """
+        页面及其模板引用的资源 ID：{"images": ..., "fonts": ..., "seals": ...}，
+        第一次读取页面时建立，释放页面内容后仍然保留
+        """
+        self.load()
+        return self._dependencies
+
+    def release(self):
+        self._page_node = None
+        self._tpl_node = None
+
+    @property
+    def page_node(self):
+        self.load()
+        return self._page_node
+
+    @property
+    def tpl_node(self):
+        self.load()
+        return self._tpl_node
+
+    @property
+    def physical_box(self):
+        page_node = self.page_node
         if "Area" in page_node and "PhysicalBox" in page_node["Area"]:
-            self.physical_box = [
+            return [
                 float(i) for i in page_node["Area"]["PhysicalBox"].text.split(" ")
             ]
-        self.tpl_node = tpl_node
-        self.page_node = page_node
-        self.seal_node = seal_node
+        return self.parent.physical_box
 
 
 class Surface(object):
-    def __init__(self, page, name, dpi=192):
+    def __init__(self, page, name, dpi=192, max_width=None, max_height=None):
         self.page = page
         self.dpi = dpi
+        self.max_width = max_width
+        self.max_height = max_height
         self.filename = name
+        self.stats = page.parent.resources.stats
 
     @property
     def pixels_per_mm(self):
-        return self.dpi * UNITS["mm"]
+        scale = self.dpi * UNITS["mm"]
+        # 限定了最大宽高时等比缩小
+        if self.max_width:
+            scale = min(scale, self.max_width / self.page.physical_box[2])
+        if self.max_height:
+            scale = min(scale, self.max_height / self.page.physical_box[3])
+        return scale
 
     def cairo_draw(self, cr, node):
         # Only draw known tags
         if node.tag in CAIRO_TAGS:
+            start = time.perf_counter() if self.stats is not None else None
             try:
-                CAIRO_TAGS[node.tag](cr, node)
+                CAIRO_TAGS[node.tag](cr, node, self.page.parent.resources)
             except Exception as e:
                 # Error in point parsing, do nothing
                 print_node_recursive(node)
                 print(traceback.format_exc())
                 pass
+            if start is not None:
+                self.stats.add_tag("draw", node.tag, time.perf_counter() - start)
             return  # no need to go deeper
 
         for child in node.children:
             # Only draw known tags
             self.cairo_draw(cr, child)
 
+    def page_size(self):
+        """
+        页面在目标分辨率下的宽高
+        """
+        physical_box = self.page.physical_box
+        return (
+            int(physical_box[2] * self.pixels_per_mm),
+            int(physical_box[3] * self.pixels_per_mm),
+        )
+
+    def template_surface(self, raster=False):
+        """
+        同一模板在同一分辨率下只绘制一次：位图输出预先渲染成带白色背景的整页位图，
+        直接作为各页的底图；矢量输出和分条绘制录制成 RecordingSurface，在各页下重放，
+        PDF 中各页共用同一个模板对象。整页位图超过 TEMPLATE_CACHE_BYTES 时也改为录制
+        """
+        document = self.page.parent
+        scale = self.pixels_per_mm
+        size = self.page_size() if raster else None
+        if raster and size[0] * size[1] * 4 > TEMPLATE_CACHE_BYTES:
+            raster, size = False, None
+        key = (self.page.tpl_id, scale, size)
+        cached = document.template_surfaces.get(key)
+        surface = cached[0] if cached is not None else None
+        if self.stats is not None:
+            self.stats.add_cache("template", surface is not None)
+        if surface is None:
+            if raster:
+                surface = cairo.ImageSurface(cairo.FORMAT_RGB24, *size)
+            else:
+                surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+            cr = cairo.Context(surface)
+            cr.scale(scale, scale)
+            if raster:
+                cr.set_source_rgb(1, 1, 1)
+                cr.paint()
+            cr.move_to(0, 0)
+            self.cairo_draw(cr, self.page.tpl_node)
+            surface.flush()
+            # 录制结果只保存绘制命令，不计入字节数
+            nbytes = surface.get_stride() * surface.get_height() if raster else 0
+            with document._template_lock:
+                surfaces = document.template_surfaces
+                if key not in surfaces:
+                    while surfaces and (
+                        len(surfaces) >= TEMPLATE_CACHE_SIZE
+                        or document.template_bytes + nbytes > TEMPLATE_CACHE_BYTES
+                    ):
+                        _, evicted = surfaces.pop(next(iter(surfaces)))
+                        document.template_bytes -= evicted
+                    surfaces[key] = (surface, nbytes)
+                    document.template_bytes += nbytes
+                surface = surfaces[key][0]
+        return surface
+
+    def paint_template(self, cr, surface):
+        # 模板按像素坐标绘制，先抵消 cr 上按毫米的缩放
+        cr.save()
+        cr.scale(1 / self.pixels_per_mm, 1 / self.pixels_per_mm)
+        cr.set_source_surface(surface, 0, 0)
+        cr.paint()
+        cr.restore()
+
+    def render(self, cr, background=False):
+        """
+        在已按毫米缩放好的 cr 上绘制模板、页面内容和印章；
+        background 为 True 表示模板已经作为底图画过
+        """
+        if self.page.tpl_node and not background:
+            self.paint_template(cr, self.template_surface())
+        self.cairo_draw(cr, self.page.page_node)
+
+        # draw StampAnnot
+        if self.page.seal_node:
+            self.cairo_draw(cr, self.page.seal_node)
+
     # 已经有 self.page 了，为什么这里还要传 page?
-    def draw(self, page, path: Optional[str] = None) -> str:
+    def draw(
+        self,
+        page,
+        path: Optional[str] = None,
+        output_format: Optional[str] = None,
+        quality: Optional[int] = None,
+        compress_level: Optional[int] = None,
+        band_height: Optional[int] = None,
+        sink=None,
+    ) -> str:
+        """
+        band_height: 给出时按该像素高度分条绘制并逐条写入 PNG，峰值内存只与条带大小有关
+        sink: 给出时 path 为输出文件名，写入 sink 并返回 sink.result(path)
+        """
+        if output_format is None:
+            output_format = (Path(path).suffix[1:] if path else "") or "png"
+        path = path or f"{self.filename}_{page.name}.{output_format}"
+        if band_height:
+            if self.stats is None:
+                return self.draw_banded(path, band_height, output_format, compress_level, sink)
+            with self.stats.stage("banded"):
+                return self.draw_banded(path, band_height, output_format, compress_level, sink)
+
+        if self.stats is None:
+            im = self.rasterize()
+            with _open_output(path, sink) as f:
+                encode_image(im, f, output_format, quality, compress_level)
+            return sink.result(path) if sink is not None else path
+        with self.stats.stage("rasterize"):
+            im = self.rasterize()
+        with self.stats.stage("encode"), _open_output(path, sink) as f:
+            encode_image(im, f, output_format, quality, compress_level)
+        return sink.result(path) if sink is not None else path
+
+    def rasterize(self):
+        """
+        绘制整页，返回 PIL 图片，接近灰度的页面转换为 L 模式
+        """
         # 计算A4 210mm 192dpi 下得到的宽高
-        physical_width = self.page.physical_box[2]
-        physical_height = self.page.physical_box[3]
-        width = int(physical_width * self.pixels_per_mm)
-        height = int(physical_height * self.pixels_per_mm)
+        width, height = self.page_size()
         # print(f"create cairo surface, width: {width}, height: {height}")
-        cairo_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        cairo_surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
 
         self.cr = cairo.Context(cairo_surface)
         # scale mm to pixels
         self.cr.scale(self.pixels_per_mm, self.pixels_per_mm)
-        self.cr.set_source_rgb(1, 1, 1)
-        self.cr.paint()
+        template = self.template_surface(raster=True) if self.page.tpl_node else None
+        if not isinstance(template, cairo.ImageSurface):
+            # 没有模板或模板为录制结果时先铺白色背景
+            self.cr.set_source_rgb(1, 1, 1)
+            self.cr.paint()
+        if template is not None:
+            self.paint_template(self.cr, template)
         self.cr.move_to(0, 0)
+        self.render(self.cr, background=True)
 
-        if self.page.tpl_node:
-            self.cairo_draw(self.cr, self.page.tpl_node)
-        self.cairo_draw(self.cr, self.page.page_node)
-
-        # self.cr.scale(self.pixels_per_mm, self.pixels_per_mm)
-        # draw StampAnnot
-        if self.page.seal_node:
-            self.cairo_draw(self.cr, self.page.seal_node)
-
-        bio = BytesIO()
-        cairo_surface.write_to_png(bio)
+        # 直接从 cairo 的 BGRX 缓冲区解出 RGB，不经过 PNG 编解码
+        cairo_surface.flush()
+        im = Image.frombuffer(
+            "RGB", (width, height), cairo_surface.get_data(), "raw", "BGRX",
+            cairo_surface.get_stride(), 1,
+        )
         cairo_surface.finish()
-        path = path or f"{self.filename}_{page.name}.png"
-        im = Image.open(bio)
-        stat_var = ImageStat.Stat(im).var
-        # detect grayscale - 100 is a naïve threshold
-        if len(stat_var) == 3 and abs(max(stat_var) - min(stat_var)) < 100:
+        if is_grayscale(im):
             im = im.convert("L")
-        im.save(path)
-        return path
+        return im
+
+    def draw_banded(self, path, band_height, output_format="png", compress_level=None, sink=None):
+        """
+        每次只分配一条 width x band_height 的 surface，平移原点后重放页面内容，
+        绘制完即编码写出；由于不能预先知道整页是否为灰度，固定输出 RGB
+        """
+        if output_format.lower() != "png":
+            raise ValueError("Banded rendering only supports png output")
+        width, height = self.page_size()
+        with _open_output(path, sink) as f:
+            writer = PNGWriter(f, width, height, "RGB", compress_level)
+            for top in range(0, height, band_height):
+                rows = min(band_height, height - top)
+                band = cairo.ImageSurface(cairo.FORMAT_RGB24, width, rows)
+                cr = cairo.Context(band)
+                # 条带之外的内容由 surface 边界裁掉
+                cr.translate(0, -top)
+                cr.scale(self.pixels_per_mm, self.pixels_per_mm)
+                cr.set_source_rgb(1, 1, 1)
+                cr.paint()
+                cr.move_to(0, 0)
+                self.render(cr)
+
+                band.flush()
+                im = Image.frombuffer(
+                    "RGB", (width, rows), band.get_data(), "raw", "BGRX",
+                    band.get_stride(), 1,
+                )
+                writer.write_rows(im.tobytes())
+                band.finish()
+            writer.close()
+        return sink.result(path) if sink is not None else path
+
+
+def _open_output(path, sink=None):
+    return sink.open(path) if sink is not None else open(path, "wb")
+
+
+# 每个文档最多缓存的模板绘制结果数
+TEMPLATE_CACHE_SIZE = 8
+# 每个文档缓存的模板底图（整页位图）合计字节数上限，单张底图超过上限时改为录制后重放
+TEMPLATE_CACHE_BYTES = int(os.getenv("OFD_TEMPLATE_CACHE_BYTES", 64 * 1024 * 1024))
+
+# 由 cairo 直接输出的矢量格式
+VECTOR_FORMATS = ("pdf", "svg")
+
+# 输出格式 -> PIL 格式名
+OUTPUT_FORMATS = {
+    "png": "PNG",
+    "jpg": "JPEG",
+    "jpeg": "JPEG",
+    "webp": "WEBP",
+}
+
+
+def encode_image(im, fp, output_format="png", quality=None, compress_level=None):
+    """
+    quality 用于 JPEG / WebP（PIL 默认分别为 75 / 80），compress_level 用于 PNG（0-9，默认 6）
+    """
+    pil_format = OUTPUT_FORMATS.get(output_format.lower())
+    if pil_format is None:
+        raise ValueError(f"Unsupported output format '{output_format}'")
+    params = {}
+    if pil_format == "PNG":
+        if compress_level is not None:
+            params["compress_level"] = compress_level
+    elif quality is not None:
+        params["quality"] = quality
+    im.save(fp, format=pil_format, **params)
+
+
+def is_grayscale(im, samples=256):
+    """
+    在缩小后的采样图上比较各通道方差，判断页面是否为灰度
+    """
+    width, height = im.size
+    step = max(1, max(width, height) // samples)
+    if step > 1:
+        im = im.resize((max(1, width // step), max(1, height // step)), Image.NEAREST)
+    stat_var = ImageStat.Stat(im).var
+    # detect grayscale - 100 is a naïve threshold
+    return len(stat_var) == 3 and abs(max(stat_var) - min(stat_var)) < 100
 
 
 CAIRO_TAGS = {
@@ -258,48 +943,120 @@ RESOURCE_TAGS = {
 }
 
 
-class Node(dict):
-    def __init__(self, element):
-        super().__init__()
-        self.element = element
-        node = element.etree_element
+OFD_NAMESPACES = ("", "http://www.ofdspec.org/2016")
+
 
+class Node(object):
+    """
+    精简的 XML 节点：node["Tag"] 按子节点标签取值（同名多个时为 list），
+    .attr / .text / .children 与 ElementTree 的含义一致
+    """
+
+    __slots__ = ("tag", "attr", "text", "children", "_index")
+
+    def __init__(self, tag, attr, text=None):
+        self.tag = tag
+        self.attr = attr
+        self.text = text
         self.children = []
-        self.text = node.text
-        self.tag = (
-            element.local_name
-            if element.namespace_url in ("", "http://www.ofdspec.org/2016")
-            else "{%s}%s" % (element.namespace_url, element.local_name)
-        )
-        self.attr = node.attrib
-        for child in element.iter_children():
-            child_node = Node(child)
-            self.children.append(child_node)
-            if child_node.tag:
-                if child_node.tag in self:
-                    if isinstance(self[child_node.tag], list):
-                        self[child_node.tag].append(child_node)
+        self._index = None
+
+    def _get_index(self):
+        # 第一次按标签取值时才建立索引，大部分叶子节点用不到
+        if self._index is None:
+            index = {}
+            for child in self.children:
+                if not child.tag:
+                    continue
+                if child.tag in index:
+                    if isinstance(index[child.tag], list):
+                        index[child.tag].append(child)
                     else:
-                        self[child_node.tag] = [self[child_node.tag], child_node]
+                        index[child.tag] = [index[child.tag], child]
                 else:
-                    self[child_node.tag] = child_node
+                    index[child.tag] = child
+            self._index = index
+        return self._index
+
+    def __getitem__(self, tag):
+        return self._get_index()[tag]
+
+    def __contains__(self, tag):
+        return tag in self._get_index()
+
+    def get(self, tag, default=None):
+        return self._get_index().get(tag, default)
 
     def __bool__(self):
-        # 否则当没有 child_node.tag 的时候，作为一个 dict，会被认为是 False
-        return bool(super().__len__()) or bool(self.tag)
+        return bool(self.children) or bool(self.tag)
+
+    @staticmethod
+    def from_bytes(document):
+        builder = _NodeBuilder()
+        parser = ElementTree.DefusedXMLParser(target=builder)
+        parser.feed(document)
+        return parser.close()
 
     @staticmethod
     def from_zp_location(zf, location):
         # print('from_zp_location', location)
-        document = zf.read(location)
-        tree = ElementTree.fromstring(document)
-        root = cssselect2.ElementWrapper.from_xml_root(tree)
-        return Node(root)
+        return Node.from_bytes(zf.read(location))
 
     def __repr__(self):
         return f"Tag: {self.tag}, Attr: {self.attr}, Text: {self.text}"
 
 
+class _NodeBuilder(object):
+    """
+    XMLParser 的 target，直接由解析事件流构建 Node，不经过中间的 Element 树
+    """
+
+    def __init__(self):
+        self.root = None
+        self.stack = []
+        self.text = []
+        self.tags = {}
+
+    def _local_name(self, tag):
+        name = self.tags.get(tag)
+        if name is None:
+            if tag[0] == "{":
+                namespace, _, local_name = tag[1:].partition("}")
+                name = local_name if namespace in OFD_NAMESPACES else tag
+            else:
+                name = tag
+            self.tags[tag] = name
+        return name
+
+    def _flush(self):
+        if self.text:
+            node = self.stack[-1]
+            # 只保留第一个子节点之前的文本，与 Element.text 一致
+            if not node.children:
+                node.text = "".join(self.text)
+            self.text = []
+
+    def start(self, tag, attrib):
+        if self.stack:
+            self._flush()
+        node = Node(self._local_name(tag), attrib)
+        if self.stack:
+            self.stack[-1].children.append(node)
+        else:
+            self.root = node
+        self.stack.append(node)
+
+    def end(self, tag):
+        self._flush()
+        self.stack.pop()
+
+    def data(self, data):
+        self.text.append(data)
+
+    def close(self):
+        return self.root
+
+
 def print_node_recursive(node, depth=0):
     print("  " * depth, node)
     for child in node.children:
@@ -0,0 +1,146 @@
+import errno
+import io
+import mmap
+import os
+import posixpath
+import time
+from zipfile import ZipFile
+
+
+class BufferReader(io.RawIOBase):
+    """
+    只读、可 seek 的内存缓冲区文件对象，供 ZipFile 读取 bytes、memoryview 或 mmap 中的 OFD；
+    不复制整个缓冲区，每次只复制读取的那一段
+    """
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast("B")
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if pos < 0:
+            # 与普通文件一致抛出 OSError，zipfile 据此识别过短的非 zip 数据
+            raise OSError(errno.EINVAL, f"Negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        data = self._view[self._pos:self._pos + len(b)]
+        n = len(data)
+        b[:n] = data
+        self._pos += n
+        return n
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else self._pos + size
+        data = self._view[self._pos:end].tobytes()
+        self._pos += len(data)
+        return data
+
+    def getbuffer(self):
+        return self._view
+
+
+def open_zip(source):
+    """
+    source 可以是路径、bytes / bytearray / memoryview / mmap，或以二进制方式打开的文件对象；
+    不能 seek 的流先整体读入内存
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return ZipFile(source)
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        return ZipFile(BufferReader(source))
+    if source.seekable():
+        return ZipFile(source)
+    return ZipFile(BufferReader(source.read()))
+
+
+class PackageIndex(object):
+    """
+    OFD 包内成员路径索引，打开文件时建立一次，之后按路径 O(1) 查找
+
+    OFD 中的路径可以是相对于文档根目录、资源文件 BaseLoc 的相对路径，
+    也可以是以 / 开头的包内绝对路径
+    """
+
+    def __init__(self, zf: ZipFile):
+        self.zf = zf
+        # 可选的 RenderStats，记录每个成员读取的字节数和耗时
+        self.stats = None
+        self.names = {}
+        self.lower_names = {}
+        self.basenames = {}
+        for name in zf.namelist():
+            if name.endswith("/"):
+                continue
+            key = self.normalize(name)
+            self.names[key] = name
+            self.lower_names.setdefault(key.lower(), name)
+            self.basenames.setdefault(posixpath.basename(key), []).append(name)
+
+    @staticmethod
+    def normalize(location):
+        location = location.strip().replace("\\", "/").lstrip("/")
+        if not location:
+            return ""
+        return posixpath.normpath(location)
+
+    @classmethod
+    def join(cls, base, location):
+        location = location.strip().replace("\\", "/")
+        if location.startswith("/") or not base:
+            return cls.normalize(location)
+        return cls.normalize(posixpath.join(base, location))
+
+    def resolve(self, location, *bases):
+        """
+        依次在 bases 下查找 location，返回 zip 中的成员名，找不到时返回 None
+        """
+        location = location.strip().replace("\\", "/")
+        if location.startswith("/"):
+            candidates = [self.normalize(location)]
+        else:
+            candidates = [self.join(base, location) for base in bases]
+            candidates.append(self.normalize(location))
+
+        for key in candidates:
+            if key in self.names:
+                return self.names[key]
+        # 部分生成工具的路径大小写与实际文件不一致
+        for key in candidates:
+            if key.lower() in self.lower_names:
+                return self.lower_names[key.lower()]
+        # 最后按文件名匹配，只在唯一时采用，避免选错文件
+        matches = self.basenames.get(posixpath.basename(candidates[0]), [])
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+    def __contains__(self, location):
+        return self.normalize(location) in self.names
+
+    def read(self, name):
+        if self.stats is None:
+            return self.zf.read(name)
+        start = time.perf_counter()
+        data = self.zf.read(name)
+        self.stats.add_stage("zip_read", time.perf_counter() - start)
+        self.stats.add_read(name, len(data))
+        return data
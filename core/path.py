@@ -0,0 +1,199 @@
+import math
+import re
+from array import array
+from functools import lru_cache
+
+# 编译后的路径操作
+MOVE_TO = 0
+LINE_TO = 1
+CURVE_TO = 2
+CLOSE_PATH = 3
+
+# 每个 AbbreviatedData 命令需要的参数个数
+COMMAND_ARITY = {
+    "S": 2,
+    "M": 2,
+    "L": 2,
+    "Q": 4,
+    "B": 6,
+    "A": 7,
+    "C": 0,
+}
+COMMAND_RE = re.compile(r"([SMLQBAC])")
+NUMBER_RE = re.compile(r"[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?")
+
+
+class CompiledPath(object):
+    """
+    AbbreviatedData 编译后的紧凑表示：ops 为操作序列，coords 为依次排列的坐标，
+    只含 move_to / line_to / curve_to / close_path，每两个坐标都是一个点
+    """
+
+    __slots__ = ("ops", "coords")
+
+    def __init__(self, ops, coords):
+        self.ops = ops
+        self.coords = coords
+
+    def transform(self, matrix):
+        """
+        matrix: 带 transform_point 方法的仿射矩阵，如 cairo.Matrix
+        """
+        coords = array("d", self.coords)
+        for i in range(0, len(coords), 2):
+            coords[i], coords[i + 1] = matrix.transform_point(coords[i], coords[i + 1])
+        return CompiledPath(self.ops, coords)
+
+    def replay(self, cr):
+        coords = self.coords
+        i = 0
+        for op in self.ops:
+            if op == LINE_TO:
+                cr.line_to(coords[i], coords[i + 1])
+                i += 2
+            elif op == MOVE_TO:
+                cr.move_to(coords[i], coords[i + 1])
+                i += 2
+            elif op == CURVE_TO:
+                cr.curve_to(*coords[i:i + 6])
+                i += 6
+            else:
+                cr.close_path()
+
+
+@lru_cache(maxsize=4096)
+def compile_path(data):
+    """
+    单遍扫描 AbbreviatedData，命令参数不足时报错，多出的参数按同一命令重复处理
+    """
+    ops = bytearray()
+    coords = array("d")
+    start_x = start_y = x = y = 0.0
+    parts = COMMAND_RE.split(data)
+    if NUMBER_RE.search(parts[0]):
+        raise Exception("操作符违法")
+
+    for i in range(1, len(parts), 2):
+        command = parts[i]
+        args = list(map(float, NUMBER_RE.findall(parts[i + 1])))
+        arity = COMMAND_ARITY[command]
+        if command == "C":
+            if args:
+                raise Exception("操作符违法")
+            ops.append(CLOSE_PATH)
+            x, y = start_x, start_y
+            continue
+        if not args or len(args) % arity:
+            raise Exception("操作符违法")
+
+        count = len(args) // arity
+        if command == "L":
+            ops.extend(bytes((LINE_TO,)) * count)
+            coords.extend(args)
+            x, y = args[-2], args[-1]
+        elif command == "B":
+            ops.extend(bytes((CURVE_TO,)) * count)
+            coords.extend(args)
+            x, y = args[-2], args[-1]
+        elif command in ("S", "M"):
+            ops.extend(bytes((MOVE_TO,)) * count)
+            coords.extend(args)
+            x, y = args[-2], args[-1]
+            start_x, start_y = x, y
+        elif command == "Q":
+            # 二次贝塞尔曲线换算成等价的三次曲线
+            for j in range(0, len(args), 4):
+                qx, qy, x2, y2 = args[j:j + 4]
+                ops.append(CURVE_TO)
+                coords.extend((
+                    x + 2.0 / 3.0 * (qx - x),
+                    y + 2.0 / 3.0 * (qy - y),
+                    x2 + 2.0 / 3.0 * (qx - x2),
+                    y2 + 2.0 / 3.0 * (qy - y2),
+                    x2,
+                    y2,
+                ))
+                x, y = x2, y2
+        else:
+            for j in range(0, len(args), 7):
+                rx, ry, angle, large_arc, sweep, x2, y2 = args[j:j + 7]
+                if (x, y) == (x2, y2):
+                    continue
+                if rx == 0 or ry == 0:
+                    ops.append(LINE_TO)
+                    coords.extend((x2, y2))
+                else:
+                    for curve in _arc_to_curves(
+                        x, y, rx, ry, angle, large_arc, sweep, x2, y2
+                    ):
+                        ops.append(CURVE_TO)
+                        coords.extend(curve)
+                x, y = x2, y2
+
+    return CompiledPath(bytes(ops), coords)
+
+
+def _vector_angle(ux, uy, vx, vy):
+    return math.atan2(ux * vy - uy * vx, ux * vx + uy * vy)
+
+
+def _arc_to_curves(x1, y1, rx, ry, angle, large_arc, sweep, x2, y2):
+    """
+    端点参数化的椭圆弧（与 SVG 的 A 命令相同）换算成若干段三次贝塞尔曲线
+    """
+    rx, ry = abs(rx), abs(ry)
+    phi = math.radians(angle)
+    cos_phi, sin_phi = math.cos(phi), math.sin(phi)
+
+    # 换算中心点参数化，见 SVG 规范 F.6.5
+    dx, dy = (x1 - x2) / 2.0, (y1 - y2) / 2.0
+    x1p = cos_phi * dx + sin_phi * dy
+    y1p = -sin_phi * dx + cos_phi * dy
+    scale = (x1p * x1p) / (rx * rx) + (y1p * y1p) / (ry * ry)
+    if scale > 1:
+        rx, ry = rx * math.sqrt(scale), ry * math.sqrt(scale)
+
+    numerator = rx * rx * ry * ry - rx * rx * y1p * y1p - ry * ry * x1p * x1p
+    denominator = rx * rx * y1p * y1p + ry * ry * x1p * x1p
+    coef = math.sqrt(max(0.0, numerator / denominator))
+    if bool(large_arc) == bool(sweep):
+        coef = -coef
+    cxp = coef * rx * y1p / ry
+    cyp = -coef * ry * x1p / rx
+    cx = cos_phi * cxp - sin_phi * cyp + (x1 + x2) / 2.0
+    cy = sin_phi * cxp + cos_phi * cyp + (y1 + y2) / 2.0
+
+    ux, uy = (x1p - cxp) / rx, (y1p - cyp) / ry
+    vx, vy = (-x1p - cxp) / rx, (-y1p - cyp) / ry
+    theta = _vector_angle(1.0, 0.0, ux, uy)
+    delta = _vector_angle(ux, uy, vx, vy)
+    if not sweep and delta > 0:
+        delta -= 2 * math.pi
+    elif sweep and delta < 0:
+        delta += 2 * math.pi
+
+    # 每段不超过 90 度
+    segments = max(1, int(math.ceil(abs(delta) / (math.pi / 2) - 1e-9)))
+    step = delta / segments
+    t = 4.0 / 3.0 * math.tan(step / 4.0)
+
+    def point(px, py):
+        return (
+            cx + rx * cos_phi * px - ry * sin_phi * py,
+            cy + rx * sin_phi * px + ry * cos_phi * py,
+        )
+
+    curves = []
+    for _ in range(segments):
+        cos1, sin1 = math.cos(theta), math.sin(theta)
+        theta += step
+        cos2, sin2 = math.cos(theta), math.sin(theta)
+        curves.append(
+            point(cos1 - t * sin1, sin1 + t * cos1)
+            + point(cos2 + t * sin2, sin2 - t * cos2)
+            + point(cos2, sin2)
+        )
+    # 终点以给定值为准，消除浮点误差
+    if curves:
+        curves[-1] = curves[-1][:4] + (x2, y2)
+    return curves
@@ -0,0 +1,55 @@
+import struct
+import zlib
+
+# PNG 颜色类型
+COLOR_TYPES = {
+    "L": (0, 1),
+    "RGB": (2, 3),
+}
+
+
+class PNGWriter(object):
+    """
+    逐行写入的 PNG 编码器，分条绘制时每条渲染完就压缩写出，内存占用只与条带大小有关
+    """
+
+    def __init__(self, fp, width, height, mode="RGB", compress_level=None):
+        self.fp = fp
+        self.width = width
+        self.height = height
+        color_type, self.channels = COLOR_TYPES[mode]
+        self.row_bytes = width * self.channels
+        self.rows = 0
+        self.compressor = zlib.compressobj(6 if compress_level is None else compress_level)
+
+        self.fp.write(b"\x89PNG\r\n\x1a\n")
+        self._write_chunk(
+            b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+        )
+
+    def _write_chunk(self, chunk_type, data):
+        self.fp.write(struct.pack(">I", len(data)))
+        self.fp.write(chunk_type)
+        self.fp.write(data)
+        self.fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xFFFFFFFF))
+
+    def write_rows(self, data):
+        """
+        data: 若干整行的像素数据，每行 width * channels 字节
+        """
+        row_bytes = self.row_bytes
+        n = len(data) // row_bytes
+        # 每行前加过滤类型字节 0（None）
+        scanlines = b"".join(
+            b"\x00" + data[i * row_bytes:(i + 1) * row_bytes] for i in range(n)
+        )
+        self.rows += n
+        compressed = self.compressor.compress(scanlines)
+        if compressed:
+            self._write_chunk(b"IDAT", compressed)
+
+    def close(self):
+        if self.rows != self.height:
+            raise ValueError(f"PNG expects {self.height} rows, got {self.rows}")
+        self._write_chunk(b"IDAT", self.compressor.flush())
+        self._write_chunk(b"IEND", b"")
@@ -1,33 +1,29 @@
+import hashlib
+import json
 import os
 import platform
-import gi
+import posixpath
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from PIL import Image as PILImage
 from io import BytesIO
 
-gi.require_version("Gtk", "3.0")
-gi.require_version("PangoCairo", "1.0")
-from gi.repository import PangoCairo
 import cairo
 import asn1
 from subprocess import Popen, PIPE
 
+from .package import PackageIndex
 
-Fonts = {}
-MultiMedias = {}
-Images = {}
-Seals = {}
-font_map = PangoCairo.font_map_get_default()
-Cairo_Font_Family_Names = [f.get_name() for f in font_map.list_families()]
-# print(Cairo_Font_Family_Names)
-# print(
-#     [
-#         f.get_name()
-#         for f in font_map.list_families()
-#         if "sun" in f.get_name().lower()
-#         or "cour" in f.get_name().lower()
-#         or "kai" in f.get_name().lower()
-#     ]
-# )
+# 系统字体列表的磁盘缓存，未设置时每个进程第一次用到字体时枚举一次
+FONT_CACHE_PATH = os.getenv("OFD_FONT_CACHE")
+FONT_CACHE_TTL = int(os.getenv("OFD_FONT_CACHE_TTL", 24 * 3600))
 
 OFD_FONT_MAP = {
     # 纯西文
@@ -92,6 +88,14 @@ class ResNotFoundException(Exception):
     pass
 
 
+class ResDecodeException(Exception):
+    """
+    资源文件解码失败
+    """
+
+    pass
+
+
 class Font(object):
     ID = ""
     FontName = ""
@@ -104,19 +108,242 @@ class Font(object):
 
     def get_font_family(self):
         # fixme: 印章的Font只有FontName， 沒有FamilyName
-        if self.FontName in OFD_FONT_MAP:
-            candidates = OFD_FONT_MAP[self.FontName]
-            for c in candidates:
-                if c in Cairo_Font_Family_Names:
-                    return c
+        family = resolve_font_family(self.FontName)
+        if family:
+            return family
         if bool(os.getenv('OFD_FONT_MUST_EXIST')):
-            raise ResNotFoundException(f"Can't find font '{self.FontName}' and its replacements {OFD_FONT_MAP[self.FontName]}!")
+            raise ResNotFoundException(f"Can't find font '{self.FontName}' and its replacements {OFD_FONT_MAP.get(self.FontName, [])}!")
         return self.FontName
 
     def __repr__(self):
         return f"ID:{self.ID}, FontName:{self.FontName} FamilyName:{self.FamilyName}, System:{self.get_font_family()}"
 
 
+@lru_cache(maxsize=None)
+def font_families():
+    """
+    系统中的字体族名称，第一次用到时才枚举
+    """
+    if FONT_CACHE_PATH:
+        try:
+            if time.time() - os.path.getmtime(FONT_CACHE_PATH) < FONT_CACHE_TTL:
+                with open(FONT_CACHE_PATH, encoding="utf-8") as f:
+                    return frozenset(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    import gi
+
+    gi.require_version("PangoCairo", "1.0")
+    from gi.repository import PangoCairo
+
+    font_map = PangoCairo.font_map_get_default()
+    families = frozenset(f.get_name() for f in font_map.list_families())
+
+    if FONT_CACHE_PATH:
+        try:
+            tmp_path = f"{FONT_CACHE_PATH}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(sorted(families), f, ensure_ascii=False)
+            os.replace(tmp_path, FONT_CACHE_PATH)
+        except OSError:
+            pass
+    return families
+
+
+@lru_cache(maxsize=None)
+def resolve_font_family(font_name):
+    """
+    按 OFD_FONT_MAP 找到系统中已安装的替代字体，找不到时返回 None
+    """
+    families = font_families()
+    for candidate in OFD_FONT_MAP.get(font_name, []):
+        if candidate in families:
+            return candidate
+    return None
+
+
+class WorkFolder(object):
+    """
+    临时目录，只有必须落盘的解码器（如 Windows 下的 jbig2dec）用到时才创建
+    """
+
+    def __init__(self):
+        self._path = None
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = tempfile.mkdtemp()
+        return self._path
+
+    def cleanup(self):
+        if self._path is not None:
+            shutil.rmtree(self._path, ignore_errors=True)
+            self._path = None
+
+
+def pil_to_cairo_surface(im):
+    """
+    把 PIL 图片按 cairo 的像素格式直接写进 ImageSurface 的缓冲区，不经过 PNG 编解码
+    """
+    if im.mode in ("RGBA", "LA", "PA") or (im.mode == "P" and "transparency" in im.info):
+        im = im.convert("RGBA")
+        cairo_format = cairo.FORMAT_ARGB32
+        # cairo 的 ARGB32 是预乘 alpha 的本机字节序
+        rawmode = "BGRa"
+    else:
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        cairo_format = cairo.FORMAT_RGB24
+        rawmode = "BGRX"
+
+    if sys.byteorder != "little":
+        bio = BytesIO()
+        im.save(bio, format="PNG")
+        bio.seek(0)
+        return cairo.ImageSurface.create_from_png(bio)
+
+    width, height = im.size
+    stride = cairo.ImageSurface.format_stride_for_width(cairo_format, width)
+    surface = cairo.ImageSurface(cairo_format, width, height)
+    surface.flush()
+    surface.get_data()[:] = im.tobytes("raw", rawmode, stride)
+    surface.mark_dirty()
+    return surface
+
+
+class SurfaceCache(object):
+    """
+    解码后的图片 surface 缓存
+
+    以图片内容的哈希为键，不同 ID 指向同一份 MediaFile 时共用一个 surface；
+    占用超过 max_bytes 时按最近最少使用的顺序淘汰
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._surfaces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, decode, stats=None):
+        with self._lock:
+            if key in self._surfaces:
+                self._surfaces.move_to_end(key)
+                self.hits += 1
+                if stats is not None:
+                    stats.add_cache("surface", True)
+                return self._surfaces[key][0]
+            self.misses += 1
+
+        if stats is None:
+            surface = decode()
+        else:
+            stats.add_cache("surface", False)
+            with stats.stage("decode"):
+                surface = decode()
+        if surface is None:
+            return None
+        nbytes = surface.get_stride() * surface.get_height()
+        if nbytes > self.max_bytes:
+            return surface
+
+        with self._lock:
+            if key not in self._surfaces:
+                self._surfaces[key] = (surface, nbytes)
+                self.size += nbytes
+                self._evict()
+            return self._surfaces[key][0]
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._surfaces:
+            _, (_, nbytes) = self._surfaces.popitem(last=False)
+            self.size -= nbytes
+            self.evictions += 1
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._surfaces
+
+    def contains_digest(self, digest):
+        """
+        是否缓存了该图片任一缩小倍数的 surface
+        """
+        with self._lock:
+            return any(key[0] == digest for key in self._surfaces)
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._surfaces.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._surfaces),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+surface_cache = SurfaceCache(
+    int(os.getenv("OFD_SURFACE_CACHE_BYTES", 256 * 1024 * 1024))
+)
+
+
+class ResourceRegistry(object):
+    """
+    单个文档的资源表
+
+    OFD 中的资源 ID 只在文件内唯一，每个文档各自持有一份，
+    多个文档可以在不同线程中同时绘制，文档关闭时一起释放
+    """
+
+    def __init__(self, package: PackageIndex):
+        self.package = package
+        self.work_folder = WorkFolder()
+        self.fonts = {}
+        self.images = {}
+        self.seals = {}
+
+    @property
+    def stats(self):
+        return self.package.stats
+
+    def prefetch(self, images=(), fonts=(), seals=()):
+        """
+        提前读取给出 ID 的图片和印章（jb2 随即提交后台解码），并预先匹配字体，
+        可以在其他线程中调用
+        """
+        for res_id in images:
+            if res_id in self.images:
+                self.images[res_id].load()
+        for seal_id in seals:
+            if seal_id in self.seals:
+                self.seals[seal_id].load()
+        for font_id in fonts:
+            if font_id in self.fonts:
+                resolve_font_family(self.fonts[font_id].FontName)
+
+    def close(self):
+        self.fonts.clear()
+        self.images.clear()
+        self.seals.clear()
+        self.work_folder.cleanup()
+
+
 class MultiMedia(object):
     def __init__(self, node):
         self.ID = node.attr["ID"]
@@ -129,63 +356,230 @@ class MultiMedia(object):
 
 
 class Image(MultiMedia):
-    def __init__(self, node, _zf, work_folder: str):
+    def __init__(self, node, package: PackageIndex, work_folder: WorkFolder, bases=()):
         super().__init__(node)
-        self.png_location = None
         self.Format = node.attr["Format"] if "Format" in node.attr else "png"
-        suffix = self.location.split(".")[-1]
-        if suffix == "jb2":
-            jb2_path = [loc for loc in _zf.namelist() if self.location in loc][0]
+        # 解析资源文件时只确定位置，第一次用到时才读取
+        self._path = package.resolve(self.location, *bases)
+        if self._path is None:
+            raise ResNotFoundException(f"Can't find image '{self.location}'!")
+        self._package = package
+        self._work_folder = work_folder
+        self._init_lazy()
+
+    def _init_lazy(self):
+        self.size = None
+        self.digest = None
+        self._future = None
+        self._data = None
+        self._jb2_data = None
+        self._jb2 = False
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _read(self):
+        return self._package.read(self._path)
+
+    def load(self):
+        """
+        从 zip 读取图片数据，只执行一次，可以在其他线程中提前调用
+        """
+        with self._lock:
+            if self._loaded:
+                return
+            data = self._read()
+            self.digest = hashlib.sha1(data).hexdigest() if data else None
+            if self._path.split(".")[-1] == "jb2":
+                self._jb2 = True
+                # 解码结果已在 surface 缓存中时不必再调用 jbig2dec
+                if not surface_cache.contains_digest(self.digest):
+                    self._jb2_data = data
+                    self._submit()
+            else:
+                # jpg、bmp、png 等 PIL 能直接解码的格式，保留原始字节，绘制时在内存中解码
+                self._data = data
+            self._loaded = True
+
+    def _submit(self):
+        # 交给 jbig2dec 进程池后台解码，用到时再取结果；解码中的相同内容共用一次解码
+        if self._future is None:
+            if self._jb2_data is None:
+                # 之前的解码结果已经释放，surface 缓存未命中时重新读取
+                self._jb2_data = self._read()
+            self._future = jbig2_submit(self._jb2_data, self.digest, self._work_folder)
+
+    def wait(self, stats=None):
+        """
+        jb2 图片等待 jbig2dec 解码完成，stats 记录等待时间；返回解码的 future
+        """
+        self.load()
+        if not self._jb2:
+            return None
+        with self._lock:
+            self._submit()
+            future = self._future
+        if stats is not None and not future.done():
+            with stats.stage("jbig2"):
+                future.result()
+        return future
+
+    @property
+    def data(self):
+        future = self.wait()
+        if future is not None:
+            return future.result()
+        data = self._data
+        # 原始数据在 surface 进入缓存后已释放，缓存未命中时从 zip 重新读取
+        return data if data is not None else self._read()
+
+    def _release(self):
+        # surface 已进入缓存，释放原始数据和 jbig2dec 的输出（整页扫描条带约 1MB），
+        # 它们不计入缓存容量，长文档中不必为每张画过的图片多保留一份
+        with self._lock:
+            self._future = None
+            self._jb2_data = None
+            self._data = None
+
+    def _decode(self, factor=1):
+        data = self.data
+        with PILImage.open(BytesIO(data)) as im:
+            if factor > 1:
+                im = _reduce_image(im, factor)
+            surface = pil_to_cairo_surface(im)
+            if factor == 1 and im.format == "JPEG" and im.mode in ("RGB", "L"):
+                # 输出 PDF 时直接嵌入原始 JPEG 数据，不再重新压缩
+                surface.set_mime_data(cairo.MIME_TYPE_JPEG, data)
+        # 内容相同的图片在 PDF 中只嵌入一次
+        surface.set_mime_data(cairo.MIME_TYPE_UNIQUE_ID, f"{self.digest}@{factor}".encode())
+        return surface
+
+    def _reduce_factor(self, size, stats=None):
+        """
+        不低于目标像素大小的前提下，可以缩小的最大 2 的幂
+        """
+        if not size:
+            return 1
+        if self.size is None:
+            self.size = _image_sizes.get(self.digest)
+        if self.size is None:
+            if stats is None:
+                self._read_size()
+            else:
+                # 读取宽高可能要等待 jbig2dec，与解码一样计入 decode
+                with stats.stage("decode"):
+                    self._read_size(stats)
+        factor = 1
+        while (
+            factor < MAX_REDUCE_FACTOR
+            and self.size[0] // (factor * 2) >= size[0]
+            and self.size[1] // (factor * 2) >= size[1]
+        ):
+            factor *= 2
+        return factor
+
+    def _read_size(self, stats=None):
+        self.wait(stats)
+        with PILImage.open(BytesIO(self.data)) as im:
+            self.size = im.size
+        _image_sizes.put(self.digest, self.size)
+
+    def get_cairo_surface(self, size=None, stats=None):
+        """
+        size: 图片在目标上的像素宽高，给出时按接近该大小的分辨率解码并缓存，缩略图不必解码原图
+        stats: 可选的 RenderStats
+        """
+        self.load()
+        if not self.digest:
+            return None
+        # 先按摘要查 surface 缓存，命中时不需要原始数据，jb2 也不必再解码
+        factor = self._reduce_factor(size, stats)
+
+        def decode():
+            self.wait(stats)
+            return self._decode(factor)
+
+        key = (self.digest, factor)
+        surface = surface_cache.get(key, decode, stats)
+        if key in surface_cache:
+            self._release()
+        return surface
+
+    def __repr__(self):
+        return f"Image ID:{self.ID}, Format:{self.Format}"
 
-            x_path = _zf.extract(jb2_path, path=work_folder)
-            png_path = x_path.replace(".jb2", ".png")
-            pbm_path = x_path.replace(".jb2", ".pbm")
 
-            if platform.system() == "Windows":
-                Popen(["./bin/jbig2dec", "-o", png_path, x_path], stdout=PIPE).communicate()
-            else:
-                Popen(["jbig2dec", "-o", pbm_path, x_path], stdout=PIPE).communicate()
-                with PILImage.open(pbm_path) as im:
-                    im.save(png_path)
+# 缩小解码的最大倍数
+MAX_REDUCE_FACTOR = 32
 
-            self.png_location = png_path
-        elif suffix in ("jpg", "jpeg", "bmp") or self.Format.lower() in ("jpg", "bmp"):
-            img_src_path = [loc for loc in _zf.namelist() if self.location in loc][0]
 
-            x_path = _zf.extract(img_src_path, path=work_folder)
-            png_path = x_path.replace(f".{suffix}", ".png")
+class _SizeCache(object):
+    """
+    图片摘要到原始宽高的映射，计算缩小倍数时不必为了读取宽高再解码 jb2
+    """
 
-            with PILImage.open(x_path) as im:
-                im.save(png_path)
-            self.png_location = png_path
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._sizes = OrderedDict()
+        self._lock = threading.Lock()
 
-    def get_cairo_surface(self):
-        if self.png_location:
-            return cairo.ImageSurface.create_from_png(self.png_location)
-        return None
+    def get(self, digest):
+        with self._lock:
+            return self._sizes.get(digest)
 
-    def __repr__(self):
-        return f"Image ID:{self.ID}, Format:{self.Format}"
+    def put(self, digest, size):
+        with self._lock:
+            self._sizes[digest] = size
+            while len(self._sizes) > self.max_entries:
+                self._sizes.popitem(last=False)
+
+
+_image_sizes = _SizeCache()
+
+
+def _reduce_image(im, factor):
+    """
+    按 factor 缩小图片；JPEG 使用 draft 模式在解码时直接缩小
+    """
+    width, height = im.size
+    target = (max(1, width // factor), max(1, height // factor))
+    if im.format == "JPEG":
+        im.draft(im.mode, target)
+    if im.mode in ("1", "P"):
+        im = im.convert("L" if im.mode == "1" else "RGBA")
+    reduce = min(im.size[0] // target[0], im.size[1] // target[1])
+    if reduce > 1:
+        im = im.reduce(reduce)
+    return im
 
 
 class Seal(Image):
-    def __init__(self, node, _zf, work_folder: str):
+    def __init__(self, node, package: PackageIndex, work_folder: WorkFolder, bases=()):
         self.ID = node.attr["ID"]
         self.Type = node.attr["Type"]
-        self.location = node.attr["BaseLoc"].split("/")[0]
-        self.png_location = None
+        # BaseLoc 指向签名描述文件，SignedValue.dat 与其在同一目录下
+        self.location = posixpath.dirname(package.resolve(node.attr["BaseLoc"], *bases) or "")
         self.Format = "png"
 
-        signedvalue_loc = [
-            loc for loc in _zf.namelist()
-            if f'{self.location}/SignedValue.dat' in loc
-        ][0]
-        signedvalue_path = _zf.extract(signedvalue_loc, path=work_folder)
+        self._path = package.resolve("SignedValue.dat", self.location)
+        if self._path is None:
+            raise ResNotFoundException(f"Can't find SignedValue.dat of seal '{self.ID}'!")
+        self._package = package
+        self._init_lazy()
+
+    def _read(self):
+        return self._parse_signed_value(self._package.read(self._path))
 
+    def load(self):
+        with self._lock:
+            if not self._loaded:
+                self._data = self._read()
+                self.digest = hashlib.sha1(self._data).hexdigest()
+                self._loaded = True
+
+    @staticmethod
+    def _parse_signed_value(signedvalue_data):
         # ASN1 在线调试工具 https://lapo.it/asn1js/
         # 从 SignedValue.dat 中解析出签章的数据
-        with open(signedvalue_path, "rb") as f:
-            signedvalue_data = f.read()
         decoder = asn1.Decoder()
         decoder.start(signedvalue_data)
         decoder.enter()
@@ -199,27 +593,89 @@ class Seal(Image):
         decoder.enter()
         _, value = decoder.read()  # value = 'gif'
         _, value = decoder.read()  # value = b'GIF89a....'
-
-        png_path = signedvalue_path.replace("SignedValue.dat", f"seal_{self.ID}.png")
-        with PILImage.open(BytesIO(value)) as im:
-            im.save(png_path)
-        self.png_location = png_path
+        return value
 
     def __repr__(self):
         return f"Seal ID:{self.ID} Format:{self.Format}"
 
 
-def res_add_font(node, _zf, work_folder):
-    Fonts[node.attr["ID"]] = Font(node.attr)
+JBIG2_WORKERS = int(os.getenv("OFD_JBIG2_WORKERS", os.cpu_count() or 1))
+_jbig2_executor = None
+# 内容相同的 jb2 只解码一次，没有 Image 引用时自动释放
+_jbig2_futures = weakref.WeakValueDictionary()
+_jbig2_lock = threading.Lock()
 
 
-def res_add_multimedia(node, _zf, work_folder):
+def jbig2_decode(jb2_data, work_folder: WorkFolder = None):
+    """
+    调用 jbig2dec 解码，返回 PBM（Windows 下为 PNG）字节
+
+    输入输出都通过管道传递，只有 Windows 下的 jbig2dec 需要落盘
+    """
+    if platform.system() == "Windows":
+        folder = tempfile.mkdtemp(dir=work_folder.path if work_folder else None)
+        try:
+            x_path = os.path.join(folder, "image.jb2")
+            png_path = os.path.join(folder, "image.png")
+            with open(x_path, "wb") as f:
+                f.write(jb2_data)
+            Popen(["./bin/jbig2dec", "-o", png_path, x_path], stdout=PIPE).communicate()
+            with open(png_path, "rb") as f:
+                return f.read()
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    proc = Popen(
+        ["jbig2dec", "-t", "pbm", "-o", "/dev/stdout", "/dev/stdin"],
+        stdin=PIPE,
+        stdout=PIPE,
+        stderr=PIPE,
+    )
+    out, err = proc.communicate(jb2_data)
+    if proc.returncode != 0 or not out:
+        raise ResDecodeException(f"jbig2dec failed: {err.decode(errors='replace').strip()}")
+    return out
+
+
+def jbig2_submit(jb2_data, digest, work_folder: WorkFolder = None) -> Future:
+    global _jbig2_executor
+    with _jbig2_lock:
+        future = _jbig2_futures.get(digest)
+        if future is None:
+            if _jbig2_executor is None:
+                _jbig2_executor = ThreadPoolExecutor(
+                    max_workers=JBIG2_WORKERS, thread_name_prefix="jbig2dec"
+                )
+            future = _jbig2_executor.submit(jbig2_decode, jb2_data, work_folder)
+            _jbig2_futures[digest] = future
+        return future
+
+
+def _reset_after_fork():
+    # fork 出的子进程不继承线程，父进程的线程池和可能被持有的锁都不能再用
+    global _jbig2_executor, _jbig2_lock
+    _jbig2_executor = None
+    _jbig2_lock = threading.Lock()
+    _jbig2_futures.clear()
+    surface_cache._lock = threading.Lock()
+    _image_sizes._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def res_add_font(node, res: ResourceRegistry, bases):
+    res.fonts[node.attr["ID"]] = Font(node.attr)
+
+
+def res_add_multimedia(node, res: ResourceRegistry, bases):
     if node.attr["Type"] == "Image":
-        image = Image(node, _zf, work_folder)
-        Images[node.attr["ID"]] = image
+        image = Image(node, res.package, res.work_folder, bases)
+        res.images[node.attr["ID"]] = image
 
 
-def res_add_signature(node, _zf, work_folder):
+def res_add_signature(node, res: ResourceRegistry, bases):
     if node.attr["Type"] == "Seal":
-        seal = Seal(node, _zf, work_folder)
-        Seals[node.attr["ID"]] = seal
+        seal = Seal(node, res.package, res.work_folder, bases)
+        res.seals[node.attr["ID"]] = seal
@@ -0,0 +1,299 @@
+"""
+常驻的本地渲染服务，字体、解码后的图片和印章缓存在请求之间共用
+
+    python -m core.server --port 8080 --concurrency 4 --queue 16
+
+    POST /render?format=png&pages=0,1&dpi=96   请求体为 OFD 文件内容
+    GET  /healthz
+    GET  /metrics
+"""
+import argparse
+import io
+import json
+import os
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.etree.ElementTree import ParseError
+from zipfile import BadZipFile
+
+from .document import OFDFile
+from .resources import font_families, resolve_font_family, surface_cache
+from .sinks import MemorySink, ZipSink
+
+# 请求体大小上限
+MAX_BODY_BYTES = int(os.getenv("OFD_SERVER_MAX_BYTES", 100 * 1024 * 1024))
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "svg": "image/svg+xml",
+    "pdf": "application/pdf",
+}
+
+
+class ServerBusy(Exception):
+    pass
+
+
+class BadRequest(Exception):
+    """
+    请求内容不是有效的 OFD 文件，或文档序号、页码超出范围
+    """
+
+
+class Admission(object):
+    """
+    最多 concurrency 个请求同时绘制，另有 queue_size 个请求排队等待，
+    再多的请求直接拒绝，避免请求堆积把内存耗尽
+
+    排队名额在接收请求体之前占用（enqueue），绘制名额在请求体接收完之后才占用（acquire），
+    上传缓慢的客户端只占排队名额，不会挡住其他请求的绘制
+    """
+
+    def __init__(self, concurrency, queue_size):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self._slots = threading.Semaphore(concurrency)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+
+    def enqueue(self):
+        with self._lock:
+            if self.active + self.queued >= self.concurrency + self.queue_size:
+                raise ServerBusy()
+            self.queued += 1
+
+    def cancel(self):
+        with self._lock:
+            self.queued -= 1
+
+    def acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+    def __enter__(self):
+        self.enqueue()
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class Metrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.rejected = 0
+        self.invalid = 0
+        self.failed = 0
+        self.pages = 0
+        self.render_seconds = 0.0
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self, admission):
+        with self._lock:
+            data = {
+                "uptime": round(time.time() - self.started, 3),
+                "requests": self.requests,
+                "rejected": self.rejected,
+                "invalid": self.invalid,
+                "failed": self.failed,
+                "pages": self.pages,
+                "render_seconds": round(self.render_seconds, 3),
+            }
+        data.update(
+            active=admission.active,
+            queued=admission.queued,
+            concurrency=admission.concurrency,
+            queue_size=admission.queue_size,
+            surface_cache=surface_cache.stats(),
+            font_cache=resolve_font_family.cache_info()._asdict(),
+        )
+        return data
+
+
+def parse_render_params(query):
+    """
+    查询参数转换为 draw_document 的参数，参数不合法时抛出 ValueError
+    """
+    params = {k: v[-1] for k, v in parse_qs(query).items()}
+    output_format = params.pop("format", "png").lower()
+    if output_format not in CONTENT_TYPES:
+        raise ValueError(f"Unsupported output format '{output_format}'")
+    options = {"output_format": output_format}
+    if "pages" in params:
+        options["pages"] = [int(i) for i in params.pop("pages").split(",") if i.strip()]
+    for name in ("quality", "compress_level", "max_width", "max_height", "doc_num"):
+        if name in params:
+            options[name] = int(params.pop(name))
+    if "dpi" in params:
+        options["dpi"] = float(params.pop("dpi"))
+    if params:
+        raise ValueError(f"Unknown parameter(s): {', '.join(sorted(params))}")
+    return options
+
+
+def render(data, options):
+    """
+    绘制 OFD 内容，返回 (响应内容, Content-Type, 页数)；
+    单个输出文件直接返回，多页图片打包成 zip，全程不落盘
+    """
+    sink = MemorySink()
+    try:
+        doc = OFDFile(data)
+    except (BadZipFile, KeyError, ParseError) as e:
+        raise BadRequest(f"Not a valid OFD file: {e}") from e
+    with doc:
+        doc_nums = options.get("doc_num", 0)
+        try:
+            # 在绘制之前检查文档序号和页码，绘制过程中的错误仍按服务端错误处理
+            for n in [doc_nums] if isinstance(doc_nums, int) else doc_nums:
+                doc.get_document(n).select_pages(options.get("pages"))
+        except IndexError as e:
+            raise BadRequest(f"{e}") from e
+        except (KeyError, ParseError) as e:
+            raise BadRequest(f"Not a valid OFD file: {e}") from e
+        names = doc.draw_document(sink=sink, **options)
+        pages = len(doc.page_timings)
+    if len(names) == 1:
+        return sink.pop(names[0]), CONTENT_TYPES[options["output_format"]], pages
+    buffer = io.BytesIO()
+    # 图片已经压缩过，zip 中不再压缩
+    with ZipSink(buffer) as zf:
+        for name in names:
+            zf.write(name, sink.pop(name))
+    return buffer.getvalue(), "application/zip", pages
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    server_version = "ofd2img"
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/healthz":
+            self._reply(200, b"ok\n", "text/plain")
+        elif path == "/metrics":
+            body = json.dumps(self.server.metrics.snapshot(self.server.admission))
+            self._reply(200, body.encode(), "application/json")
+        else:
+            self._reply(404, b"Not found\n", "text/plain")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/render":
+            self._reply(404, b"Not found\n", "text/plain")
+            return
+        metrics = self.server.metrics
+        metrics.add(requests=1)
+        try:
+            options = parse_render_params(url.query)
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError as e:
+            self._reply(400, f"{e}\n".encode(), "text/plain")
+            return
+        if length <= 0:
+            self._reply(400, b"Request body must be an OFD file\n", "text/plain")
+            return
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            self._reply(413, b"Request body too large\n", "text/plain")
+            return
+
+        admission = self.server.admission
+        try:
+            admission.enqueue()
+            try:
+                data = self.rfile.read(length)
+            except BaseException:
+                admission.cancel()
+                raise
+            if len(data) < length:
+                # 客户端在上传完之前断开
+                admission.cancel()
+                self.close_connection = True
+                return
+            admission.acquire()
+            try:
+                start = time.perf_counter()
+                body, content_type, pages = render(data, options)
+                metrics.add(pages=pages, render_seconds=time.perf_counter() - start)
+            finally:
+                admission.release()
+        except ServerBusy:
+            metrics.add(rejected=1)
+            self.close_connection = True
+            self._reply(503, b"Server busy\n", "text/plain", {"Retry-After": "1"})
+            return
+        except BadRequest as e:
+            metrics.add(invalid=1)
+            self._reply(400, f"{e}\n".encode(), "text/plain")
+            return
+        except Exception as e:
+            metrics.add(failed=1)
+            traceback.print_exc()
+            self._reply(500, f"{type(e).__name__}: {e}\n".encode(), "text/plain")
+            return
+        self._reply(200, body, content_type)
+
+    def _reply(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RenderServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, concurrency=None, queue_size=16):
+        super().__init__(address, RenderHandler)
+        self.admission = Admission(concurrency or os.cpu_count() or 1, queue_size)
+        self.metrics = Metrics()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地 OFD 渲染服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--concurrency", type=int, default=os.cpu_count() or 1, help="同时绘制的请求数"
+    )
+    parser.add_argument("--queue", type=int, default=16, help="排队等待的请求数上限")
+    args = parser.parse_args(argv)
+
+    # 启动时枚举字体，第一个请求不必等待
+    font_families()
+    server = RenderServer((args.host, args.port), args.concurrency, args.queue)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+绘制结果的输出位置。draw_document 按输出文件名调用 sink.open(name) 得到可写的二进制文件对象，
+写完关闭即可；返回值中每个输出对应 sink.result(name)
+"""
+import io
+import zipfile
+from pathlib import Path
+
+
+class FileSink(object):
+    """
+    写入目录，draw_document 的默认行为，返回文件路径
+    """
+
+    def __init__(self, destination="."):
+        self.destination = Path(destination)
+        self.destination.mkdir(exist_ok=True, parents=True)
+
+    def path(self, name):
+        return self.destination / name
+
+    def open(self, name):
+        return open(self.path(name), "wb")
+
+    def write(self, name, data):
+        with self.open(name) as f:
+            f.write(data)
+
+    def result(self, name):
+        return self.path(name)
+
+    def close(self):
+        pass
+
+
+class _Buffer(io.BytesIO):
+    """
+    关闭时把内容交给回调，供内存和 zip 输出使用
+    """
+
+    def __init__(self, on_close):
+        super().__init__()
+        self._on_close = on_close
+
+    def close(self):
+        if not self.closed:
+            self._on_close(self.getvalue())
+        super().close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            # 绘制出错时丢弃写了一半的内容
+            self._on_close = lambda data: None
+        self.close()
+
+
+class MemorySink(object):
+    """
+    保存在内存中，files 为 {文件名: 字节}，返回文件名
+    """
+
+    def __init__(self):
+        self.files = {}
+
+    def open(self, name):
+        return _Buffer(lambda data: self.write(name, data))
+
+    def write(self, name, data):
+        self.files[name] = bytes(data)
+
+    def pop(self, name):
+        return self.files.pop(name)
+
+    def result(self, name):
+        return name
+
+    def close(self):
+        pass
+
+
+class ZipSink(object):
+    """
+    写入 zip 包，target 为路径或可写的文件对象；每个输出写完后立即加入 zip，
+    内存中最多保留一页。图片本身已经压缩，默认不再压缩
+    """
+
+    def __init__(self, target, compression=zipfile.ZIP_STORED):
+        self.zf = zipfile.ZipFile(target, "w", compression)
+
+    def open(self, name):
+        return _Buffer(lambda data: self.write(name, data))
+
+    def write(self, name, data):
+        self.zf.writestr(name, data)
+
+    def result(self, name):
+        return name
+
+    def close(self):
+        self.zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,96 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class RenderStats(object):
+    """
+    可选的渲染统计：各阶段和各标签的次数与累计耗时（秒）、每个 zip 成员读取的字节数、
+    各缓存的命中次数。未启用时各处只多一次 None 判断
+
+    stages: 阶段名 -> [次数, 耗时]，如 open、zip_read、xml_parse、decode、rasterize、encode；
+        decode 包含等待 jbig2dec 的时间，其中的等待另外记为 jbig2
+    tags: 类别 -> 标签名 -> [次数, 耗时]，类别为 draw（CAIRO_TAGS）和 res（RESOURCE_TAGS）
+    members: zip 成员名 -> 累计读取字节数
+    caches: 缓存名 -> {"hits": 命中次数, "misses": 未命中次数}
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.tags = {}
+        self.members = {}
+        self.caches = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, seconds, count=1):
+        with self._lock:
+            entry = self.stages.setdefault(name, [0, 0.0])
+            entry[0] += count
+            entry[1] += seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_tag(self, kind, tag, seconds):
+        with self._lock:
+            entry = self.tags.setdefault(kind, {}).setdefault(tag, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def add_read(self, name, nbytes):
+        with self._lock:
+            self.members[name] = self.members.get(name, 0) + nbytes
+
+    def add_cache(self, name, hit):
+        with self._lock:
+            entry = self.caches.setdefault(name, {"hits": 0, "misses": 0})
+            entry["hits" if hit else "misses"] += 1
+
+    def merge(self, other):
+        """
+        合并另一份统计（RenderStats 或 as_dict() 的结果），用于汇总各工作进程的数据
+        """
+        if isinstance(other, RenderStats):
+            other = other.as_dict()
+        with self._lock:
+            for name, (count, seconds) in other["stages"].items():
+                entry = self.stages.setdefault(name, [0, 0.0])
+                entry[0] += count
+                entry[1] += seconds
+            for kind, tags in other["tags"].items():
+                for tag, (count, seconds) in tags.items():
+                    entry = self.tags.setdefault(kind, {}).setdefault(tag, [0, 0.0])
+                    entry[0] += count
+                    entry[1] += seconds
+            for name, nbytes in other["members"].items():
+                self.members[name] = self.members.get(name, 0) + nbytes
+            for name, counts in other["caches"].items():
+                entry = self.caches.setdefault(name, {"hits": 0, "misses": 0})
+                entry["hits"] += counts["hits"]
+                entry["misses"] += counts["misses"]
+
+    def as_dict(self):
+        """
+        可直接序列化为 JSON 的副本
+        """
+        with self._lock:
+            return {
+                "stages": {name: list(entry) for name, entry in self.stages.items()},
+                "tags": {
+                    kind: {tag: list(entry) for tag, entry in tags.items()}
+                    for kind, tags in self.tags.items()
+                },
+                "members": dict(self.members),
+                "caches": {name: dict(entry) for name, entry in self.caches.items()},
+            }
+
+    def __repr__(self):
+        stages = ", ".join(
+            f"{name}: {count}x {seconds:.3f}s" for name, (count, seconds) in self.stages.items()
+        )
+        return f"RenderStats({stages})"
@@ -1,9 +1,13 @@
+import math
 import re
+from functools import lru_cache
+from itertools import accumulate
+
 import gi
 
-from .resources import Fonts, Images, Seals
+from .path import compile_path
+from .resources import ResourceRegistry
 
-gi.require_version("Gtk", "3.0")
 gi.require_version("PangoCairo", "1.0")
 from gi.repository import Pango, PangoCairo
 import cairo
@@ -14,17 +18,6 @@ COMMANDS = set("SMLQBAC")
 COMMAND_RE = re.compile(r"([SMLQBAC])")
 FLOAT_RE = re.compile(r"[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?")
 
-font_map = PangoCairo.font_map_get_default()
-# print(
-#     [
-#         f.get_name()
-#         for f in font_map.list_families()
-#         if "song" in f.get_name().lower()
-#         or "cour" in f.get_name().lower()
-#         or "kai" in f.get_name().lower()
-#     ]
-# )
-
 
 def _tokenize_path(pathdef):
     for x in COMMAND_RE.split(pathdef):
@@ -66,52 +59,25 @@ def _draw_AbbreviatedData(
             pass
 
 
-def _cairo_draw_path(cr, boundary, path):
-    x_start = boundary[0]
-    y_start = boundary[1]
-    current_pos = (x_start, y_start)
-    # cr.translate(x_start, y_start)
-    elements = list(_tokenize_path(path))
-    elements.reverse()
+# 同一段 AbbreviatedData 在模板、各页之间反复出现，按内容缓存编译结果，带 CTM 的路径
+# 缓存变换后的坐标。缓存的是用户空间下的浮点坐标，重放时才由 cairo 换算到设备空间，
+# 不同分辨率的绘制共用缓存也不会带入其他分辨率的取整（cairo 的 copy_path 则是设备空间的定点数）
+CAIRO_PATH_CACHE_SIZE = 4096
 
-    command = None
-    while elements:
-        if elements[-1] in COMMANDS:
-            command = elements.pop()
-        else:
-            raise Exception("操作符违法")
 
-        if command == "M":
-            x = float(elements.pop())
-            y = float(elements.pop())
-            cr.move_to(x, y)
+@lru_cache(maxsize=CAIRO_PATH_CACHE_SIZE)
+def _transformed_path(path, ctm):
+    return compile_path(path).transform(cairo.Matrix(*ctm))
 
-        elif command == "L":
-            x = float(elements.pop())
-            y = float(elements.pop())
-            # pos = (x_start + x, y_start + y)
-            cr.line_to(x, y)
-            # draw.line(current_pos + pos, fill=fillColor, width=lineWidth)
 
-        elif command == "B":
-            x1 = float(elements.pop())
-            y1 = float(elements.pop())
-            x2 = float(elements.pop())
-            y2 = float(elements.pop())
-            x3 = float(elements.pop())
-            y3 = float(elements.pop())
-            cr.curve_to(x1, y1, x2, y2, x3, y3)
-        elif command == "A":
-            # cr.arc()
-            pass
-        elif command == "Q":
-            x1 = float(elements.pop())
-            y1 = float(elements.pop())
-            x2 = float(elements.pop())
-            y2 = float(elements.pop())
-            cr.curve_to(x1, y1, x1, y1, x2, y2)
-        elif command == "C":
-            pass
+def _cairo_draw_path(cr, path, ctm=None, stats=None):
+    cached = _transformed_path if ctm else compile_path
+    hits = cached.cache_info().hits if stats is not None else None
+    compiled = _transformed_path(path, ctm) if ctm else compile_path(path)
+    if stats is not None:
+        # 多线程绘制时只是近似值
+        stats.add_cache("path", cached.cache_info().hits > hits)
+    compiled.replay(cr)
 
 
 def _trans_Delta(elements, scale=SCALE_192):
@@ -129,7 +95,7 @@ def _trans_Delta(elements, scale=SCALE_192):
     return parsed
 
 
-def cairo_path(cr, node):
+def cairo_path(cr, node, res: ResourceRegistry):
     lineWidth = float(node.attr["LineWidth"]) if "LineWidth" in node.attr else 0.5
     boundary = [float(i) for i in node.attr["Boundary"].split(" ")]
     ctm = None
@@ -147,32 +113,30 @@ def cairo_path(cr, node):
         ]
     # print('draw path', boundary, fillColor, strokeColor)
     AbbreviatedData = node["AbbreviatedData"].text
-    cr.save()
     if ctm:
-        # 如果有ctm，对cr进行的矩阵变换
-        # print('cairo path ctm:', ctm)
-        ctm_matrix = cairo.Matrix(*ctm)
-        _, mx, my, _, lx, ly = AbbreviatedData.strip().split(" ")
-        mx, my = ctm_matrix.transform_point(float(mx), float(my))
-        lx, ly = ctm_matrix.transform_point(float(lx), float(ly))
-        AbbreviatedData = f"M {mx} {my} L {lx} {ly}"
-        lineWidth = ctm_matrix.transform_distance(lineWidth, 0)[0]
-    cr.translate(boundary[0], boundary[1])
-
-    cr.set_source_rgba(*strokeColor)
-    cr.set_line_width(lineWidth)
-    _cairo_draw_path(cr, boundary, AbbreviatedData)
-    cr.stroke()
-    cr.restore()
+        # 如果有ctm，路径上的点按 ctm 变换，线宽同样缩放
+        lineWidth = cairo.Matrix(*ctm).transform_distance(lineWidth, 0)[0]
+    cr.save()
+    try:
+        cr.translate(boundary[0], boundary[1])
+
+        cr.set_source_rgba(*strokeColor)
+        cr.set_line_width(lineWidth)
+        cr.new_path()
+        _cairo_draw_path(cr, AbbreviatedData, tuple(ctm) if ctm else None, res.stats)
+        cr.stroke()
+    finally:
+        # 出错时也要恢复，否则之后绘制的内容都会偏移
+        cr.restore()
 
 
-def cairo_text(cr, node):
+def cairo_text(cr, node, res: ResourceRegistry):
     boundary = [float(i) for i in node.attr["Boundary"].split(" ")]
     ctm = None
     if "CTM" in node.attr:
         ctm = [float(i) for i in node.attr["CTM"].split(" ")]
     font_id = node.attr["Font"]
-    font_family = get_font_from_id(font_id).get_font_family()
+    font_family = get_font_from_id(res, font_id).get_font_family()
     font_size = float(node.attr["Size"]) / 1.3
     fillColor = [0, 0, 0]
     if "FillColor" in node:
@@ -189,6 +153,8 @@ def cairo_text(cr, node):
     TextCode = node["TextCode"]
     text = TextCode.text
     # print(f'cario text {text}, {font_id}')
+    if not text:
+        return
 
     deltaX = None
     deltaY = None
@@ -206,71 +172,111 @@ def cairo_text(cr, node):
 
     X = float(TextCode.attr["X"])
     Y = float(TextCode.attr["Y"])
-    for idx, rune in enumerate(text):
-        cr.save()
-        # cr.identity_matrix()
-        # cr.scale(SCALE_128, SCALE_128)
+    offsets_x = _prefix_offsets(deltaX, len(text))
+    offsets_y = _prefix_offsets(deltaY, len(text))
+
+    cr.save()
+    cr.move_to(boundary[0], boundary[1])
+    if ctm:
+        cr.transform(cairo.Matrix(*ctm))
+    cr.rel_move_to(X, Y)
+    x0, y0 = cr.get_current_point()
+    cr.set_source_rgb(*fillColor)
+
+    scaled_font = get_scaled_font(font_family, font_size)
+    glyphs = scaled_font.text_to_glyphs(0, 0, text, False) if scaled_font else []
+    if len(glyphs) == len(text) and all(glyph[0] for glyph in glyphs):
+        # 整个 TextCode 作为一组定位好的字形一次绘制
+        cr.set_scaled_font(scaled_font)
+        cr.show_glyphs([
+            cairo.Glyph(glyph[0], x0 + offset_x, y0 + offset_y)
+            for glyph, offset_x, offset_y in zip(glyphs, offsets_x, offsets_y)
+        ])
+    else:
+        # 字体中缺字时交给 Pango 逐字绘制，由它选择替代字体
         layout = PangoCairo.create_layout(cr)
-        layout.set_text(rune, -1)
-        # print(font_family, rune)
+        layout.set_font_description(get_font_description(font_family, font_size))
+        for rune, offset_x, offset_y in zip(text, offsets_x, offsets_y):
+            layout.set_text(rune, -1)
+            cr.move_to(x0 + offset_x, y0 + offset_y)
+            PangoCairo.show_layout_line(cr, layout.get_line(0))
+    cr.restore()
+
+
+def _prefix_offsets(delta, n):
+    """
+    第 i 个字符相对于第一个字符的偏移，即 delta 的前缀和
+    """
+    if not delta:
+        return [0.0] * n
+    offsets = [0.0]
+    offsets.extend(accumulate(delta))
+    if len(offsets) < n:
+        offsets.extend([offsets[-1]] * (n - len(offsets)))
+    return offsets[:n]
+
+
+_font_descriptions = {}
+_scaled_fonts = {}
+
+
+def get_font_description(font_family, font_size):
+    key = (font_family, font_size)
+    desc = _font_descriptions.get(key)
+    if desc is None:
         desc = Pango.FontDescription.from_string(f"{font_family} {font_size}")
-        layout.set_font_description(desc)
-
-        ink_rect, logical_rect = layout.get_pixel_extents()
-        r_w, r_h = layout.get_size()
-        baseline = layout.get_baseline() / Pango.SCALE
-        # print(f'{rune}, baseline: {baseline}, X:{X}, Y:{Y} Boundary:{boundary}')
-
-        offset_x = sum(deltaX[:idx]) if deltaX else 0
-        offset_y = sum(deltaY[:idx]) if deltaY else 0
-        # cr.move_to(boundary[0] + offset_x, boundary[1] + offset_y)
-        cr.move_to(boundary[0], boundary[1])
-        if ctm:
-            matrix = cr.get_matrix().multiply(cairo.Matrix(*ctm))
-            cr.set_matrix(matrix)
-        cr.rel_move_to(X + offset_x, Y + offset_y)
-
-        cr.set_source_rgb(*fillColor)
-        # PangoCairo.show_layout(cr, layout)
-        PangoCairo.show_layout_line(cr, layout.get_line(0))
-        cr.restore()
-    pass
+        _font_descriptions[key] = desc
+    return desc
+
+
+def get_scaled_font(font_family, font_size):
+    """
+    Pango 为该字体描述匹配到的字体对应的 cairo ScaledFont，按字体和字号缓存
+    """
+    key = (font_family, font_size)
+    if key not in _scaled_fonts:
+        font_map = PangoCairo.font_map_get_default()
+        font = font_map.load_font(
+            font_map.create_context(), get_font_description(font_family, font_size)
+        )
+        _scaled_fonts[key] = PangoCairo.Font.get_scaled_font(font) if font else None
+    return _scaled_fonts[key]
 
 
-def cairo_image(cr, node):
+def cairo_image(cr, node, res: ResourceRegistry):
     resource_id = node.attr["ResourceID"]
     boundary = [float(i) for i in node.attr["Boundary"].split(" ")]
     ctm = None
     if "CTM" in node.attr:
         ctm = [float(i) for i in node.attr["CTM"].split(" ")]
-    img_surface = get_res_image(resource_id).get_cairo_surface()
 
     cr.save()
-    x, y = boundary[0], boundary[1]
-    width, height = cr.get_matrix().transform_point(boundary[2], boundary[3])
-    x, y = cr.get_matrix().transform_point(x, y)
-
-    # 画图片是fillparent，自己重新计算缩放matrix， 同时缩放基础点x，y
-    matrix = cairo.Matrix(
-        width / img_surface.get_width(), 0, 0, height / img_surface.get_height(), 0, 0
-    )
-    if ctm:  # 再过几天，我保证不记得自己为什么会这么写
-        matrix = cairo.Matrix(*map(lambda x: x * SCALE_192, ctm))
-        matrix.scale(img_surface.get_width() ** -1, img_surface.get_height() ** -1)
-    cr.identity_matrix()
-    cr.set_matrix(matrix)
-    matrix.invert()
-    cr.set_source_surface(img_surface, x, y)
+    cr.translate(boundary[0], boundary[1])
+    if ctm:
+        # CTM 把图片的单位正方形映射到 Boundary 内的坐标
+        cr.transform(cairo.Matrix(*ctm))
+    else:
+        cr.scale(boundary[2], boundary[3])
+
+    size = None
+    if isinstance(cr.get_target(), cairo.ImageSurface):
+        # 位图输出时按图片在页面上的像素大小解码；矢量输出保留原图
+        size = (
+            math.ceil(math.hypot(*cr.user_to_device_distance(1, 0))),
+            math.ceil(math.hypot(*cr.user_to_device_distance(0, 1))),
+        )
+    img_surface = get_res_image(res, resource_id).get_cairo_surface(size, res.stats)
+    cr.scale(img_surface.get_width() ** -1, img_surface.get_height() ** -1)
+    cr.set_source_surface(img_surface, 0, 0)
     cr.paint()
     cr.restore()
-    pass
 
 
-def cairo_seal(cr, node):
+def cairo_seal(cr, node, res: ResourceRegistry):
     seal_id = node.attr["ID"]
     boundary = [float(i) for i in node.attr["Boundary"].split(" ")]
     width, height = boundary[2], boundary[3]
-    seal_surface = get_res_seal(seal_id).get_cairo_surface()
+    seal_surface = get_res_seal(res, seal_id).get_cairo_surface(stats=res.stats)
 
     cr.save()
     x, y = boundary[0], boundary[1]
@@ -284,13 +290,13 @@ def cairo_seal(cr, node):
     cr.restore()
 
 
-def get_font_from_id(font_id):
-    return Fonts.get(font_id)
+def get_font_from_id(res: ResourceRegistry, font_id):
+    return res.fonts.get(font_id)
 
 
-def get_res_image(res_id):
-    return Images.get(res_id)
+def get_res_image(res: ResourceRegistry, res_id):
+    return res.images.get(res_id)
 
 
-def get_res_seal(seal_id):
-    return Seals.get(seal_id)
+def get_res_seal(res: ResourceRegistry, seal_id):
+    return res.seals.get(seal_id)
@@ -1,6 +1,5 @@
 from core.document import OFDFile
 import os
-import img2pdf
 
 os.environ['OFD_FONT_MUST_EXIST'] = "1"
 folder = "ofds"
@@ -14,7 +13,5 @@ for path in os.listdir(folder):
     img_paths = [p.as_posix() for p in doc.draw_document(destination=destination, output_format="jpg")]
     print(f"> Converted image(s):")
     print("\n".join(img_paths))
-    pdf_path = os.path.join(folder, path.replace(".ofd", ".pdf"))
+    pdf_path = doc.draw_document(destination=folder, output_format="pdf")[0]
     print(f"> Writing to PDF: {pdf_path}")
-    with open(pdf_path, 'wb') as pdf:
-        pdf.write(img2pdf.convert(img_paths))
@@ -0,0 +1,94 @@
+"""
+AbbreviatedData 编译结果的几何检查，不依赖 cairo
+
+    python -m unittest discover tests
+"""
+import math
+import unittest
+
+from core.path import CLOSE_PATH, CURVE_TO, LINE_TO, MOVE_TO, compile_path
+
+
+def curves(path):
+    """
+    按 ops 拆出每段三次曲线的 6 个坐标
+    """
+    result = []
+    i = 0
+    for op in path.ops:
+        if op == CURVE_TO:
+            result.append(tuple(path.coords[i:i + 6]))
+            i += 6
+        elif op in (MOVE_TO, LINE_TO):
+            i += 2
+    return result
+
+
+class ArcTest(unittest.TestCase):
+    def test_endpoint_is_exact(self):
+        # 旋转的椭圆弧经过三角函数换算后终点会有浮点误差，应当以给定值为准
+        path = compile_path("M 1.3 2.7 A 7.1 3.9 33 1 0 11.9 -4.3")
+        last = curves(path)[-1]
+        self.assertEqual(last[4:], (11.9, -4.3))
+
+    def test_half_circle_is_split_into_quarters(self):
+        path = compile_path("M 0 0 A 5 5 0 0 1 10 0")
+        self.assertEqual(path.ops, bytes((MOVE_TO, CURVE_TO, CURVE_TO)))
+        first, second = curves(path)
+        self.assertAlmostEqual(first[4], 5.0)
+        self.assertAlmostEqual(abs(first[5]), 5.0)
+        self.assertEqual(second[4:], (10.0, 0.0))
+
+    def test_quarter_circle_control_points(self):
+        # 四分之一圆的控制点到端点的距离为 4/3·tan(π/8)·r ≈ 0.5523·r
+        r = 10.0
+        path = compile_path("M 10 0 A 10 10 0 0 1 0 10")
+        (curve,) = curves(path)
+        k = 4.0 / 3.0 * math.tan(math.pi / 8)
+        self.assertAlmostEqual(k, 0.5523, places=4)
+        self.assertAlmostEqual(curve[0], r)
+        self.assertAlmostEqual(curve[1], k * r)
+        self.assertAlmostEqual(curve[2], k * r)
+        self.assertAlmostEqual(curve[3], r)
+
+    def test_degenerate_arcs(self):
+        # 半径为 0 时画直线，终点与起点重合时忽略
+        path = compile_path("M 1 1 A 0 5 0 0 1 4 5 A 3 3 0 0 1 4 5")
+        self.assertEqual(path.ops, bytes((MOVE_TO, LINE_TO)))
+        self.assertEqual(list(path.coords), [1, 1, 4, 5])
+
+
+class CommandTest(unittest.TestCase):
+    def test_quadratic_to_cubic(self):
+        path = compile_path("M 0 0 Q 3 3 6 0")
+        (curve,) = curves(path)
+        for got, want in zip(curve, (2, 2, 4, 2, 6, 0)):
+            self.assertAlmostEqual(got, want)
+
+    def test_close_resets_current_point(self):
+        # C 之后当前点回到子路径起点 (1, 1)，而不是最后一个 L 的 (5, 5)
+        path = compile_path("M 1 1 L 5 1 L 5 5 C Q 1 4 1 7")
+        self.assertEqual(path.ops[-2], CLOSE_PATH)
+        (curve,) = curves(path)
+        for got, want in zip(curve, (1, 3, 1, 5, 1, 7)):
+            self.assertAlmostEqual(got, want)
+
+    def test_repeated_arguments(self):
+        path = compile_path("M 0 0 L 1 1 2 2")
+        self.assertEqual(path.ops, bytes((MOVE_TO, LINE_TO, LINE_TO)))
+
+    def test_invalid(self):
+        for data in (
+            "1 2 M 3 4",  # 第一个命令之前有参数
+            "M 1",  # 参数不足
+            "M 0 0 L 1 2 3",  # 参数个数不是整数倍
+            "M 0 0 C 5",  # C 不带参数
+            "M 0 0 Q",
+        ):
+            with self.subTest(data=data):
+                with self.assertRaisesRegex(Exception, "操作符违法"):
+                    compile_path(data)
+
+
+if __name__ == "__main__":
+    unittest.main()